@@ -0,0 +1,83 @@
+import numpy as np
+
+from ReplaceTTTBuild import CHUNK_SIZE, NOT_OVER, child_states, game_outcomes, one_ply_back, outcome_values, state_keys, total_pieces
+from ReplaceTTTSolver import INITIAL_COUNTS, TicTacToe, pieces_left
+from ReplaceTTTTablebase import memo_lookup
+
+# Moves are numbered cell * 3 + size, in get_valid_moves order
+MOVE_COUNT = 27
+# move_values entry of a move that cannot be played
+ILLEGAL = -128
+# best_moves entry of a finished position
+NO_BEST_MOVE = -1
+
+
+def evaluate_positions(boards, counts, sides=None, memo_file_path="full_search_updated.tb", initial_counts=INITIAL_COUNTS):
+    # Evaluate a batch of positions given as 27-bit board codes and packed
+    # counts (a game's symmetry_hashes[0] and packed_counts). Returns
+    # (values, best_moves, move_values): the minimax value of each position,
+    # its best move, and an (n, 27) array with the value of every move.
+    # Children are looked up in the table all at once, and only the ones it
+    # is missing are searched live. A finished position has no moves and the
+    # value of its result.
+    boards = np.asarray(boards, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    total = total_pieces(initial_counts)
+    position_sides = (total - pieces_left(counts)) & 1
+    if sides is not None and np.any(np.asarray(sides) != position_sides):
+        raise ValueError("side to move does not match the number of pieces played")
+
+    game = TicTacToe(initial_counts=initial_counts, memo_file_path=memo_file_path)
+    values = np.zeros(len(boards), dtype=np.int8)
+    best_moves = np.full(len(boards), NO_BEST_MOVE, dtype=np.int8)
+    move_values = np.full((len(boards), MOVE_COUNT), ILLEGAL, dtype=np.int8)
+    for side in (0, 1):
+        positions = np.flatnonzero(position_sides == side)
+        for begin in range(0, len(positions), CHUNK_SIZE):
+            index = positions[begin:begin + CHUNK_SIZE]
+            values[index], best_moves[index], move_values[index] = evaluate_chunk(
+                game, boards[index], counts[index], side)
+    return values, best_moves, move_values
+
+
+def evaluate_chunk(game, boards, counts, side, missing=None):
+    # evaluate_positions for positions that all have `side` to move. Given a
+    # `missing` mask, children the table lacks are not searched; their
+    # parents are flagged in it instead and their values are not to be trusted.
+    outcomes = game_outcomes(boards, counts, side)
+    values = outcome_values(outcomes)
+    best_moves = np.full(len(boards), NO_BEST_MOVE, dtype=np.int8)
+    move_values = np.full((len(boards), MOVE_COUNT), ILLEGAL, dtype=np.int8)
+
+    open_positions = np.flatnonzero(outcomes == NOT_OVER)
+    if len(open_positions) == 0:
+        return values, best_moves, move_values
+    open_boards = boards[open_positions]
+    open_counts = counts[open_positions]
+    for move, legal, child_boards, child_counts in child_states(open_boards, open_counts, side):
+        # The other side moves in a child
+        child_outcomes = game_outcomes(child_boards, child_counts, side ^ 1)
+        child_values = outcome_values(child_outcomes)
+
+        open_children = np.flatnonzero(child_outcomes == NOT_OVER)
+        found, found_values = memo_lookup(game.memo, state_keys(child_boards[open_children], child_counts[open_children], side ^ 1))
+        child_values[open_children[found]] = found_values[found]
+        absent = open_children[~found]
+        if missing is not None:
+            missing[open_positions[np.flatnonzero(legal)[absent]]] = True
+            absent = absent[:0]
+        for child in absent.tolist():
+            game.load_position(int(child_boards[child]), int(child_counts[child]))
+            child_values[child] = game.minimax(0, side == 1)
+        # A move is worth its child's value one ply further from the end
+        move_values[open_positions[legal], move] = one_ply_back(child_values)
+
+    # X maximizes and O minimizes; argmax/argmin keep the first best move
+    open_values = move_values[open_positions]
+    if side == 0:
+        best = open_values.argmax(axis=1)
+    else:
+        best = np.where(open_values == ILLEGAL, 127, open_values).argmin(axis=1)
+    best_moves[open_positions] = best
+    values[open_positions] = open_values[np.arange(len(open_positions)), best]
+    return values, best_moves, move_values
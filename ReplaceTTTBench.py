@@ -0,0 +1,250 @@
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from ReplaceTTTBuild import RetrogradeBuilder
+from ReplaceTTTSolver import TicTacToe
+
+# Everything a run measures is derived from these, so runs are comparable
+SEED = 2024
+POSITION_COUNT = 2000
+MAX_PLIES = 10
+# Mid-game positions for the minimax benchmark, as the moves leading to them
+MIDGAME_OPENINGS = [
+    [(1, 1, "l"), (0, 0, "m"), (2, 2, "s"), (0, 2, "m")],
+    [(0, 0, "s"), (1, 1, "m"), (2, 2, "l"), (0, 2, "s"), (2, 0, "m")],
+    [(1, 1, "s"), (1, 1, "m"), (0, 0, "l"), (2, 2, "l"), (0, 2, "m"), (2, 0, "s")],
+    [(0, 1, "m"), (1, 0, "m"), (1, 2, "s"), (2, 1, "s"), (1, 1, "l"), (0, 0, "l")],
+]
+REDUCED_COUNTS = {
+    "X": {"s": 2, "m": 1, "l": 1},
+    "O": {"s": 2, "m": 1, "l": 1}
+}
+# Inventory for the parallel build benchmark, big enough that workers pay off
+PARALLEL_COUNTS = {
+    "X": {"s": 2, "m": 2, "l": 1},
+    "O": {"s": 2, "m": 2, "l": 1}
+}
+TRAINING_EPISODES = 2000
+# Allowed slowdown against the baseline before a benchmark counts as a regression
+DEFAULT_THRESHOLD = 0.10
+
+
+def seeded_positions(count=POSITION_COUNT, seed=SEED):
+    # Games set up at positions from seeded random playouts, finished games included
+    rng = random.Random(seed)
+    positions = []
+    while len(positions) < count:
+        game = TicTacToe(memo_file_path=None)
+        for _ in range(rng.randint(0, MAX_PLIES)):
+            if game.check_game_over() is not None:
+                break
+            game.make_move(*rng.choice(game.get_valid_moves()))
+        positions.append(game)
+    return positions
+
+
+def time_per_call(function, items, repeats):
+    # Best time over `repeats` passes through `items`, in nanoseconds per call
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for item in items:
+            function(item)
+        best = min(best, time.perf_counter() - start)
+    return best / len(items) * 1e9
+
+
+def best_time(function, repeats):
+    # Best wall time of `repeats` calls, in seconds
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_micro(repeats):
+    games = seeded_positions()
+    board_strings = [format(game.symmetry_hashes[0], "027b") for game in games]
+    canonicalizer = games[0]
+    return {
+        "encoded_game_state": time_per_call(lambda game: game.encoded_game_state(), games, repeats),
+        "canonical_form": time_per_call(canonicalizer.canonical_form, board_strings, repeats),
+        "get_valid_moves": time_per_call(lambda game: game.get_valid_moves(), games, repeats),
+        "check_game_over": time_per_call(lambda game: game.check_game_over(), games, repeats),
+    }
+
+
+def solve_midgames():
+    for opening in MIDGAME_OPENINGS:
+        game = TicTacToe(memo_file_path=None)
+        for move in opening:
+            game.make_move(*move)
+        game.best_move()
+
+
+def solve_reduced():
+    TicTacToe(initial_counts=REDUCED_COUNTS, memo_file_path=None).populate_memoization_table()
+
+
+def build_reduced():
+    RetrogradeBuilder(initial_counts=REDUCED_COUNTS).build()
+
+
+def build_speedup(repeats):
+    # Serial over parallel wall time of a retrograde build, with a worker per
+    # CPU and at least two; below 1 the workers cost more than they save
+    jobs = max(2, os.cpu_count() or 1)
+    serial = best_time(lambda: RetrogradeBuilder(initial_counts=PARALLEL_COUNTS).build(), repeats)
+    parallel = best_time(lambda: RetrogradeBuilder(initial_counts=PARALLEL_COUNTS, jobs=jobs).build(), repeats)
+    return serial / parallel
+
+
+def perft_rate(repeats):
+    # perft(3) from the empty board, in leaf nodes per second
+    game = TicTacToe(memo_file_path=None)
+    seconds = best_time(lambda: game.perft(3), repeats)
+    return game.perft(3)["nodes"] / seconds
+
+
+def training_rate():
+    # train_agent episodes per second. It prints and reads and writes its
+    # Q-tables in the working directory, so run it in a scratch one.
+    from ReplaceTTTML import train_agent
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()):
+        os.chdir(directory)
+        try:
+            random.seed(SEED)
+            start = time.perf_counter()
+            train_agent(TRAINING_EPISODES)
+            return TRAINING_EPISODES / (time.perf_counter() - start)
+        finally:
+            os.chdir(working_directory)
+
+
+# name -> (unit, whether higher is better)
+UNITS = {
+    "encoded_game_state": ("ns/call", False),
+    "canonical_form": ("ns/call", False),
+    "get_valid_moves": ("ns/call", False),
+    "check_game_over": ("ns/call", False),
+    "perft": ("nodes/s", True),
+    "minimax_midgame": ("s", False),
+    "populate_reduced": ("s", False),
+    "retrograde_reduced": ("s", False),
+    "retrograde_parallel_speedup": ("x", True),
+    "train_agent": ("episodes/s", True),
+}
+
+
+def run_benchmarks(names=None, repeats=5):
+    # Results keyed by benchmark name: {"value", "unit", "higher_is_better"}
+    names = set(names or UNITS)
+    values = {}
+    if names & {"encoded_game_state", "canonical_form", "get_valid_moves", "check_game_over"}:
+        values.update(bench_micro(repeats))
+    if "perft" in names:
+        values["perft"] = perft_rate(repeats)
+    if "minimax_midgame" in names:
+        values["minimax_midgame"] = best_time(solve_midgames, repeats)
+    if "populate_reduced" in names:
+        values["populate_reduced"] = best_time(solve_reduced, max(1, repeats // 2))
+    if "retrograde_reduced" in names:
+        values["retrograde_reduced"] = best_time(build_reduced, repeats)
+    if "retrograde_parallel_speedup" in names:
+        values["retrograde_parallel_speedup"] = build_speedup(max(1, repeats // 2))
+    if "train_agent" in names:
+        values["train_agent"] = max(training_rate() for _ in range(max(1, repeats // 2)))
+    return {
+        name: {"value": value, "unit": UNITS[name][0], "higher_is_better": UNITS[name][1]}
+        for name, value in values.items() if name in names
+    }
+
+
+def compare_results(results, baseline, threshold=DEFAULT_THRESHOLD, thresholds=None):
+    # Relative change of every benchmark also in the baseline, positive when
+    # it got worse, and the names of those worse than their threshold
+    changes = {}
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["value"]
+        if before:
+            change = (result["value"] - before) / before
+        else:
+            # Any move away from a zero baseline is infinitely large
+            change = math.copysign(math.inf, result["value"]) if result["value"] else 0.0
+        if result["higher_is_better"]:
+            change = -change
+        changes[name] = change
+        if change > (thresholds or {}).get(name, threshold):
+            regressions.append(name)
+    return changes, regressions
+
+
+def write_results(path, results):
+    document = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "seed": SEED,
+        "benchmarks": results,
+    }
+    with open(path, "w") as file:
+        json.dump(document, file, indent=2)
+        file.write("\n")
+
+
+def load_results(path):
+    with open(path) as file:
+        return json.load(file)["benchmarks"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Replace-TTT engine and trainer")
+    parser.add_argument("--only", nargs="+", choices=sorted(UNITS), help="run just these benchmarks")
+    parser.add_argument("--repeats", type=int, default=5, help="timing passes, the best one counts")
+    parser.add_argument("--output", default=None, help="write the results here as JSON")
+    parser.add_argument("--baseline", default=None, help="compare against results saved with --output")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown as a fraction, 0.10 = 10%%")
+    parser.add_argument("--threshold-for", nargs="+", default=[], metavar="NAME=FRACTION",
+                        help="allowed slowdown for single benchmarks")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.only, args.repeats)
+    if args.output:
+        write_results(args.output, results)
+
+    changes, regressions = {}, []
+    if args.baseline:
+        thresholds = {name: float(fraction) for name, fraction in
+                      (setting.split("=") for setting in args.threshold_for)}
+        changes, regressions = compare_results(results, load_results(args.baseline), args.threshold, thresholds)
+    for name, result in results.items():
+        change = ""
+        if name in changes:
+            direction = "worse" if changes[name] > 0 else "better"
+            if math.isinf(changes[name]):
+                change = f"  {direction} than a zero baseline, change n/a"
+            else:
+                change = f"  {abs(changes[name]):.1%} {direction} than baseline"
+        marker = "  REGRESSION" if name in regressions else ""
+        print(f"{name:20} {result['value']:12.2f} {result['unit']}{change}{marker}")
+    if regressions:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,425 @@
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+from ReplaceTTTSolver import (
+    BOARD_MASK, CELL_SHIFTS, COUNT_SHIFTS, DECIDED, INITIAL_COUNTS, LINES, SIDE_SHIFT, WIN,
+    TicTacToe, canonical_forms, format_time, get_current_date_time, pack_counts
+)
+from ReplaceTTTCheckpoint import CHECKPOINT_ENTRIES, CHECKPOINT_SECONDS, compact_checkpoints
+from ReplaceTTTCompressed import write_compressed
+from ReplaceTTTRanking import RankedTable
+from ReplaceTTTStats import SearchStats
+from ReplaceTTTTablebase import (
+    COMPRESSED_EXTENSION, NO_MOVE, RANKED_EXTENSION, TABLE_EXTENSION, save_memo, write_table
+)
+
+# Game outcomes as stored in the per-layer outcome arrays
+NOT_OVER = 0
+X_WINS = 1
+O_WINS = 2
+DRAW = 3
+
+# Number of parent states expanded at once, bounds the temporary arrays
+CHUNK_SIZE = 1 << 18
+
+
+def total_pieces(initial_counts):
+    return sum(count for sizes in initial_counts.values() for count in sizes.values())
+
+
+def board_cells(boards):
+    # Split 27-bit board codes into a (9, n) array of cell codes
+    return [(boards >> shift) & 7 for shift in CELL_SHIFTS]
+
+
+def game_outcomes(boards, counts, side):
+    # Vectorized check_game_over for states that all have `side` to move
+    cells = board_cells(boards)
+    x_mask = np.zeros(len(boards), dtype=np.int64)
+    o_mask = np.zeros(len(boards), dtype=np.int64)
+    for cell, code in enumerate(cells):
+        x_mask |= ((code != 0) & (code < 4)).astype(np.int64) << cell
+        o_mask |= (code >= 4).astype(np.int64) << cell
+
+    # Scan lines backwards so the first line in check_connect_3 order wins
+    outcomes = np.full(len(boards), NOT_OVER, dtype=np.int8)
+    for line in reversed(LINES):
+        outcomes[o_mask & line == line] = O_WINS
+        outcomes[x_mask & line == line] = X_WINS
+
+    # Largest size the side to move still holds, -1 when it has nothing left
+    largest = np.full(len(boards), -1, dtype=np.int64)
+    for size, shift in enumerate(COUNT_SHIFTS[side]):
+        largest[(counts >> shift) & 3 > 0] = size
+    opponent_owner = 1 - side
+    has_target = np.zeros(len(boards), dtype=bool)
+    for code in cells:
+        replaceable = (code != 0) & ((code >> 2) == opponent_owner) & ((code & 3) <= largest)
+        has_target |= (code == 0) | replaceable
+    has_move = (largest >= 0) & has_target
+
+    full = (x_mask | o_mask) == 0b111111111
+    settled = (outcomes == NOT_OVER) & (full | ~has_move)
+    # check_game_over unpacks the keys of count_pieces_on_board ("X", "O"), so
+    # a settled board always goes to X; the table has to agree with minimax
+    outcomes[settled] = X_WINS
+    return outcomes
+
+
+def outcome_values(outcomes):
+    # Same scores terminal_value gives finished games
+    values = np.zeros(len(outcomes), dtype=np.int8)
+    values[outcomes == X_WINS] = WIN
+    values[outcomes == O_WINS] = -WIN
+    return values
+
+
+def one_ply_back(values):
+    # Vectorized one_ply_back: children's values as seen from their parents
+    return np.where(values > DECIDED, values - 1, np.where(values < -DECIDED, values + 1, values)).astype(np.int8)
+
+
+def child_states(boards, counts, side):
+    # Yield (move, parent mask, child boards, child counts) for each of the 27
+    # (cell, size) moves, in get_valid_moves order; move is cell * 3 + size
+    new_codes = [(side << 2) | (size + 1) for size in range(3)]
+    cells = board_cells(boards)
+    for cell, code in enumerate(cells):
+        owned_by_opponent = (code != 0) & ((code >> 2) != side)
+        for size in range(3):
+            shift = COUNT_SHIFTS[side][size]
+            legal = ((counts >> shift) & 3 > 0) & ((code == 0) | (owned_by_opponent & ((code & 3) <= size)))
+            if not legal.any():
+                continue
+            child_boards = boards[legal] + ((new_codes[size] - code[legal]) << CELL_SHIFTS[cell])
+            yield cell * 3 + size, legal, child_boards, counts[legal] - (1 << shift)
+
+
+def state_keys(boards, counts, side):
+    # Same integer as TicTacToe.encoded_game_state, for states with `side` to move
+    canonical, _ = canonical_forms(boards)
+    return (side << SIDE_SHIFT) | (canonical << 12) | counts
+
+
+def key_boards(keys):
+    # Canonical board codes of state keys
+    return (keys >> 12) & BOARD_MASK
+
+
+def canonical_keys(boards, counts, side, stats=None):
+    if stats is None:
+        return state_keys(boards, counts, side)
+    return stats.canonicalize(state_keys, boards, counts, side)
+
+
+def expand_chunk(parents, side, stats=None):
+    # Distinct child keys of parent keys that all have `side` to move
+    children = [canonical_keys(child_boards, child_counts, side ^ 1, stats)
+                for _, _, child_boards, child_counts in child_states(key_boards(parents), parents & 0xFFF, side)]
+    return np.unique(np.concatenate(children)) if children else np.zeros(0, dtype=np.int64)
+
+
+def solve_chunk(chunk, side, child_keys, child_values, stats=None):
+    # Values and best moves of open states with `side` to move, from the
+    # sorted keys and values of the layer below
+    # X maximizes, O minimizes
+    best = np.full(len(chunk), -128 if side == 0 else 127, dtype=np.int8)
+    best_moves = np.full(len(chunk), NO_MOVE, dtype=np.uint8)
+    for move, legal, child_boards, child_counts in child_states(key_boards(chunk), chunk & 0xFFF, side):
+        child_index = np.searchsorted(child_keys, canonical_keys(child_boards, child_counts, side ^ 1, stats))
+        found = one_ply_back(child_values[child_index])
+        if stats is not None:
+            stats.memo_hits += len(found)
+        # Only a strictly better child replaces the best move, so ties
+        # keep the first move in get_valid_moves order like best_move
+        parents = np.flatnonzero(legal)
+        improved = found > best[parents] if side == 0 else found < best[parents]
+        best[parents[improved]] = found[improved]
+        best_moves[parents[improved]] = move
+    return best, best_moves
+
+
+# The layer below the one being solved, in each worker process of a
+# RetrogradeBuilder with jobs > 1; the pool's initializer sets it
+CHILD_LAYER = {}
+
+
+def set_child_layer(child_keys, child_values):
+    CHILD_LAYER["keys"] = child_keys
+    CHILD_LAYER["values"] = child_values
+
+
+def expand_chunk_in_worker(parents, side, with_stats):
+    stats = SearchStats() if with_stats else None
+    return expand_chunk(parents, side, stats), stats
+
+
+def solve_chunk_in_worker(chunk, side, with_stats):
+    stats = SearchStats() if with_stats else None
+    return solve_chunk(chunk, side, CHILD_LAYER["keys"], CHILD_LAYER["values"], stats) + (stats,)
+
+
+class RetrogradeBuilder:
+    # Every move uses up one piece, so states are layered by the number of
+    # pieces left. Layers are enumerated forwards from the start position and
+    # solved backwards, each layer only reading the one below it. With jobs > 1
+    # each layer's states are dealt out in chunks to that many worker
+    # processes, so every state is still expanded and solved exactly once.
+    def __init__(self, initial_counts=INITIAL_COUNTS, build_dir=None, isTimed=False, stats=None, jobs=1):
+        self.initial_counts = initial_counts
+        self.total = total_pieces(initial_counts)
+        self.build_dir = build_dir
+        self.isTimed = isTimed
+        self.jobs = jobs
+        # SearchStats to fill in: states per layer as nodes per depth, finished
+        # states as terminal hits, child lookups as memo hits, states held as memo size
+        self.stats = stats
+        self.keys = {}  # pieces left -> sorted state keys
+        self.outcomes = {}  # pieces left -> outcome of each state
+        self.values = {}  # pieces left -> minimax value of each state, in plies to the end
+        self.moves = {}  # pieces left -> canonical best move of each state, or NO_MOVE
+        if build_dir:
+            os.makedirs(build_dir, exist_ok=True)
+
+    def side_to_move(self, pieces_left):
+        return (self.total - pieces_left) & 1
+
+    def depth(self, pieces_left):
+        # minimax depth of a state: best_move searches the root's children at 0
+        return self.total - pieces_left - 1
+
+    def layer_path(self, name, pieces_left):
+        return os.path.join(self.build_dir, f"layer_{pieces_left:02d}_{name}.npy")
+
+    def load_layer(self, name, pieces_left):
+        if self.build_dir and os.path.exists(self.layer_path(name, pieces_left)):
+            return np.load(self.layer_path(name, pieces_left))
+        return None
+
+    def save_layer(self, name, pieces_left, array):
+        if self.build_dir:
+            # Write then rename so an interrupted build never leaves a torn layer
+            path = self.layer_path(name, pieces_left)
+            with open(path + ".tmp", "wb") as file:
+                np.save(file, array)
+            os.replace(path + ".tmp", path)
+
+    def chunks(self, states):
+        # Split an array into CHUNK_SIZE pieces, or smaller ones so that
+        # every worker gets a share of the layer
+        size = max(1, min(CHUNK_SIZE, -(-len(states) // self.jobs)))
+        return [states[begin:begin + size] for begin in range(0, len(states), size)]
+
+    def merge_stats(self, stats):
+        if stats is not None:
+            self.stats.merge(stats)
+
+    def log(self, message):
+        if self.isTimed:
+            print(message, "at")
+            get_current_date_time()
+
+    def enumerate_layers(self):
+        start = np.array([pack_counts(self.initial_counts)], dtype=np.int64)
+        previous = start
+        for pieces_left in range(self.total, -1, -1):
+            layer_start = time.perf_counter()
+            keys = self.load_layer("keys", pieces_left)
+            if keys is None:
+                if pieces_left == self.total:
+                    keys = start
+                else:
+                    keys = self.expand_layer(previous, pieces_left + 1)
+                self.save_layer("keys", pieces_left, keys)
+            outcomes = self.load_layer("outcomes", pieces_left)
+            if outcomes is None:
+                outcomes = game_outcomes(key_boards(keys), keys & 0xFFF, self.side_to_move(pieces_left))
+                self.save_layer("outcomes", pieces_left, outcomes)
+            self.keys[pieces_left] = keys
+            self.outcomes[pieces_left] = outcomes
+            previous = keys[outcomes == NOT_OVER]
+            if self.stats is not None:
+                self.stats.nodes_per_depth[self.depth(pieces_left)] = len(keys)
+                self.stats.terminal_hits += len(keys) - len(previous)
+                self.stats.memo_size(sum(len(layer) for layer in self.keys.values()))
+                self.stats.add_phase(f"enumerate layer {pieces_left}", time.perf_counter() - layer_start)
+            self.log(f"Enumerated layer {pieces_left}: {len(keys)} states")
+
+    def expand_layer(self, parents, parent_pieces_left):
+        side = self.side_to_move(parent_pieces_left)
+        chunks = self.chunks(parents)
+        if self.jobs > 1:
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                results = executor.map(expand_chunk_in_worker, chunks, repeat(side), repeat(self.stats is not None))
+                children = []
+                for chunk_children, stats in results:
+                    self.merge_stats(stats)
+                    children = [np.unique(np.concatenate(children + [chunk_children]))]
+        else:
+            children = []
+            for chunk in chunks:
+                # Deduplicate as we go to keep the candidate list small
+                children = [np.unique(np.concatenate(children + [expand_chunk(chunk, side, self.stats)]))]
+        return children[0] if children else np.zeros(0, dtype=np.int64)
+
+    def solve_layers(self):
+        for pieces_left in range(0, self.total + 1):
+            layer_start = time.perf_counter()
+            values = self.load_layer("values", pieces_left)
+            moves = self.load_layer("moves", pieces_left)
+            if values is None or moves is None:
+                values, moves = self.solve_layer(pieces_left)
+                self.save_layer("values", pieces_left, values)
+                self.save_layer("moves", pieces_left, moves)
+            self.values[pieces_left] = values
+            self.moves[pieces_left] = moves
+            if self.stats is not None:
+                self.stats.add_phase(f"solve layer {pieces_left}", time.perf_counter() - layer_start)
+            self.log(f"Solved layer {pieces_left}")
+
+    def solve_layer(self, pieces_left):
+        keys = self.keys[pieces_left]
+        outcomes = self.outcomes[pieces_left]
+        values = outcome_values(outcomes)
+        moves = np.full(len(keys), NO_MOVE, dtype=np.uint8)
+
+        open_states = np.flatnonzero(outcomes == NOT_OVER)
+        if len(open_states) == 0:
+            return values, moves
+        side = self.side_to_move(pieces_left)
+        child_keys = self.keys[pieces_left - 1]
+        child_values = self.values[pieces_left - 1]
+
+        indexes = self.chunks(open_states)
+        if self.jobs > 1:
+            # Each worker receives the layer below once, from the initializer
+            with ProcessPoolExecutor(max_workers=self.jobs, initializer=set_child_layer,
+                                     initargs=(child_keys, child_values)) as executor:
+                results = list(executor.map(solve_chunk_in_worker, [keys[index] for index in indexes],
+                                            repeat(side), repeat(self.stats is not None)))
+        else:
+            results = [solve_chunk(keys[index], side, child_keys, child_values, self.stats) + (None,)
+                       for index in indexes]
+        for index, (best, best_moves, stats) in zip(indexes, results):
+            self.merge_stats(stats)
+            values[index] = best
+            # The keys are canonical boards, so the moves are in canonical coordinates
+            moves[index] = best_moves
+        return values, moves
+
+    def build(self):
+        if self.isTimed:
+            print("Starting retrograde build at")
+            get_current_date_time()
+            start_time = time.time()
+
+        self.enumerate_layers()
+        self.solve_layers()
+
+        if self.isTimed:
+            elapsed_time = time.time() - start_time
+            print("Duration:", format_time(elapsed_time))
+            print("Finished retrograde build at")
+            get_current_date_time()
+
+    def table_arrays(self):
+        # Sorted keys, values and best moves of memo(), without building the dict
+        keys = []
+        values = []
+        moves = []
+        for pieces_left in range(0, self.total):
+            open_states = self.outcomes[pieces_left] == NOT_OVER
+            keys.append(self.keys[pieces_left][open_states])
+            values.append(self.values[pieces_left][open_states])
+            moves.append(self.moves[pieces_left][open_states])
+        keys = np.concatenate(keys)
+        order = np.argsort(keys, kind="stable")
+        return keys[order], np.concatenate(values)[order], np.concatenate(moves)[order]
+
+    def memo(self):
+        # The memo minimax would have filled: every open state below the root
+        memo = {}
+        for pieces_left in range(0, self.total):
+            open_states = self.outcomes[pieces_left] == NOT_OVER
+            memo.update(zip(self.keys[pieces_left][open_states].tolist(),
+                            self.values[pieces_left][open_states].tolist()))
+        return memo
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the Replace-TTT memoization table")
+    parser.add_argument("--output", default="full_search_updated" + TABLE_EXTENSION,
+                        help="compact table (.tb), ranked table (.rtb), compressed table (.ctb) or pickled memo dict (.pkl)")
+    parser.add_argument("--method", choices=["retrograde", "minimax"], default="retrograde",
+                        help="bottom-up layer solve, or populate_memoization_table from the empty board")
+    parser.add_argument("--build-dir", default=None,
+                        help="keep finished layers here so an interrupted build can resume")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="worker processes sharing out each layer; --method minimax with more than one "
+                             "builds the layers this way too")
+    parser.add_argument("--timed", action="store_true")
+    parser.add_argument("--stats", default=None,
+                        help="write node counts, memo hit rates and timings here as JSON")
+    parser.add_argument("--checkpoint-dir", default=None,
+                        help="for --method minimax with --jobs 1: save new entries here as they are found "
+                             "and resume from them")
+    parser.add_argument("--checkpoint-entries", type=int, default=CHECKPOINT_ENTRIES,
+                        help="write a checkpoint segment after this many new entries")
+    parser.add_argument("--checkpoint-seconds", type=float, default=CHECKPOINT_SECONDS,
+                        help="or after this many seconds")
+    parser.add_argument("--max-memory", type=float, default=None,
+                        help="for --method minimax: memo budget in MB, spilling sorted runs to disk beyond it")
+    parser.add_argument("--spill-dir", default=None,
+                        help="where --max-memory spills runs, in a new directory it removes afterwards; "
+                             "by default next to --output")
+    args = parser.parse_args()
+    stats = SearchStats() if args.stats else None
+
+    if args.method == "minimax":
+        game = TicTacToe(memo_file_path=None, stats=stats)
+        max_memory = int(args.max_memory * (1 << 20)) if args.max_memory else None
+        spill_dir = None
+        if max_memory:
+            # Spill into a directory of our own, the only one removed afterwards
+            parent = args.spill_dir or os.path.dirname(os.path.abspath(args.output))
+            os.makedirs(parent, exist_ok=True)
+            spill_dir = tempfile.mkdtemp(prefix=os.path.basename(args.output) + ".spill.", dir=parent)
+        game.populate_memoization_table(isTimed=args.timed, jobs=args.jobs, checkpoint_dir=args.checkpoint_dir,
+                                        checkpoint_entries=args.checkpoint_entries,
+                                        checkpoint_seconds=args.checkpoint_seconds,
+                                        spill_dir=spill_dir, max_memory=max_memory)
+        if max_memory:
+            game.memo.save(args.output)
+            os.rmdir(spill_dir)
+        elif args.checkpoint_dir:
+            # Every entry is in a segment by now, so merge those instead of
+            # serializing the memo
+            compact_checkpoints(args.checkpoint_dir, args.output)
+        else:
+            save_memo(args.output, game.memo)
+        if stats is not None:
+            stats.to_json(args.stats)
+        return
+
+    builder = RetrogradeBuilder(build_dir=args.build_dir, isTimed=args.timed, stats=stats, jobs=args.jobs)
+    builder.build()
+    if stats is not None:
+        stats.to_json(args.stats)
+    if args.output.endswith(TABLE_EXTENSION):
+        write_table(args.output, *builder.table_arrays())
+    elif args.output.endswith(RANKED_EXTENSION):
+        keys, values, _ = builder.table_arrays()
+        RankedTable.from_arrays(keys, values).save(args.output)
+    elif args.output.endswith(COMPRESSED_EXTENSION):
+        write_compressed(args.output, *builder.table_arrays())
+    else:
+        save_memo(args.output, builder.memo())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import glob
+import os
+import time
+
+import numpy as np
+
+from ReplaceTTTTablebase import TABLE_EXTENSION, CompactTable, save_memo, write_table
+
+# Checkpoints of a long populate_memoization_table run are a directory of
+# segment files, each a compact table (see ReplaceTTTTablebase.py) of the
+# entries added since the previous one. A segment is written to a temporary
+# file and renamed, so a crash leaves whole segments behind or none.
+SEGMENT_PATTERN = "segment_*" + TABLE_EXTENSION
+CHECKPOINT_ENTRIES = 1000000
+CHECKPOINT_SECONDS = 60
+# Inserts between looks at the clock, which would cost more than the insert
+CLOCK_CHECK_INSERTS = 4096
+
+
+def segment_paths(directory):
+    return sorted(glob.glob(os.path.join(directory, SEGMENT_PATTERN)))
+
+
+def load_checkpoints(directory):
+    # Sorted keys and values of every segment in `directory`
+    columns = [CompactTable(path).arrays() for path in segment_paths(directory)]
+    if not columns:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int8)
+    keys = np.concatenate([segment_keys for segment_keys, _ in columns])
+    values = np.concatenate([segment_values for _, segment_values in columns])
+    # Values do not depend on when a state was solved, so any copy will do
+    keys, first = np.unique(keys, return_index=True)
+    return keys, values[first]
+
+
+def compact_checkpoints(directory, path, initial_counts=None):
+    # Merge the segments into one table in the format `path` names, then
+    # delete them. Returns the number of entries.
+    keys, values = load_checkpoints(directory)
+    if path.endswith(TABLE_EXTENSION):
+        write_table(path, keys, values)
+    else:
+        save_memo(path, dict(zip(keys.tolist(), values.tolist())), initial_counts)
+    for segment in segment_paths(directory):
+        os.remove(segment)
+    return len(keys)
+
+
+class CheckpointedMemo(dict):
+    # Memo dict that writes its new entries to a segment every `every_entries`
+    # entries or `every_seconds` seconds, whichever comes first, and starts
+    # from the segments already in `directory`. The clock is only read every
+    # CLOCK_CHECK_INSERTS inserts. A checkpoint only writes the entries since
+    # the last one. Lookups are the dict's own.
+    def __init__(self, directory, every_entries=CHECKPOINT_ENTRIES, every_seconds=CHECKPOINT_SECONDS):
+        super().__init__()
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.every_entries = every_entries
+        self.every_seconds = every_seconds
+        paths = segment_paths(directory)
+        self.next_segment = int(os.path.basename(paths[-1])[8:-len(TABLE_EXTENSION)]) + 1 if paths else 0
+        keys, values = load_checkpoints(directory)
+        dict.update(self, zip(keys.tolist(), values.tolist()))
+        self.resumed = len(self)
+        self.pending = []  # Keys added since the last checkpoint
+        self.inserts = 0
+        self.last_checkpoint = time.monotonic()
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.pending.append(key)
+        dict.__setitem__(self, key, value)
+        self.inserts += 1
+        if len(self.pending) >= self.every_entries or (
+                self.inserts % CLOCK_CHECK_INSERTS == 0
+                and time.monotonic() - self.last_checkpoint >= self.every_seconds):
+            self.checkpoint()
+
+    def update(self, memo):
+        # A worker's memo merged in goes into the next checkpoint whole
+        self.pending.extend(key for key in memo if key not in self)
+        dict.update(self, memo)
+        if len(self.pending) >= self.every_entries or time.monotonic() - self.last_checkpoint >= self.every_seconds:
+            self.checkpoint()
+
+    def checkpoint(self):
+        # Write the entries added since the last checkpoint as a new segment
+        if self.pending:
+            keys = np.array(self.pending, dtype=np.uint64)
+            values = np.array([dict.__getitem__(self, key) for key in self.pending], dtype=np.int8)
+            order = np.argsort(keys)
+            path = os.path.join(self.directory, f"segment_{self.next_segment:06d}{TABLE_EXTENSION}")
+            write_table(path, keys[order], values[order])
+            self.next_segment += 1
+            self.pending = []
+        self.last_checkpoint = time.monotonic()
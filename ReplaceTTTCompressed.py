@@ -0,0 +1,309 @@
+import os
+import struct
+import sys
+
+import numpy as np
+
+from ReplaceTTTTablebase import NO_MOVE, load_table, save_memo, table_columns
+
+# Compressed table file, for shipping a table: keys are cut into blocks of
+# BLOCK_SIZE. The index holds each block's first key and where its other keys
+# start in the key stream, which has them as LEB128 varints of the gaps
+# between neighbours. Values, and best moves when there are any, are columns
+# of fixed-width codes: code c < len(palette) stands for palette[c], the
+# commonest values first, and the all-ones code for the next value in the
+# block's run of exceptions, which are stored whole. A lookup decodes one block.
+#
+# Layout: header, value palette, move palette, first keys, key offsets,
+# value exception offsets, move exception offsets, key stream, value codes,
+# value exceptions, move codes, move exceptions. The offset arrays have one
+# entry per block plus a final end offset; absent moves take no space.
+COMPRESSED_MAGIC = b"RTTTCB01"
+# magic, entries, block size, blocks, value code width, value palette size,
+# move code width (0 without moves), move palette size
+COMPRESSED_HEADER = struct.Struct("<8sQIIBBBB")
+BLOCK_SIZE = 512
+# Decoded block columns kept for repeat lookups
+BLOCK_CACHE = 256
+# Longest varint of a key gap: 40-bit keys take six 7-bit groups
+VARINT_BYTES = 6
+ENCODE_CHUNK = 1 << 20
+
+
+def varint_lengths(numbers):
+    # Bytes in the varint of each number
+    lengths = np.ones(len(numbers), dtype=np.int64)
+    for group in range(1, VARINT_BYTES):
+        lengths[numbers >> np.uint64(7 * group) > 0] = group + 1
+    return lengths
+
+
+def encode_varints(numbers):
+    # LEB128 bytes of non-negative integers, in order
+    pieces = []
+    for begin in range(0, len(numbers), ENCODE_CHUNK):
+        chunk = numbers[begin:begin + ENCODE_CHUNK].astype(np.uint64)
+        groups = np.array([(chunk >> np.uint64(7 * group)) & np.uint64(0x7F) for group in range(VARINT_BYTES)],
+                          dtype=np.uint8).T
+        lengths = varint_lengths(chunk)
+        used = np.arange(VARINT_BYTES) < lengths[:, None]
+        groups[np.arange(VARINT_BYTES) < lengths[:, None] - 1] |= 0x80
+        pieces.append(groups[used])
+    return np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.uint8)
+
+
+def decode_varints(data):
+    # Inverse of encode_varints
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    last = data < 0x80
+    starts = np.concatenate([[0], np.flatnonzero(last)[:-1] + 1])
+    number = np.concatenate([[0], np.cumsum(last)[:-1]])
+    group = np.arange(len(data)) - starts[number]
+    parts = (data & 0x7F).astype(np.uint64) << (7 * group).astype(np.uint64)
+    return np.add.reduceat(parts, starts)
+
+
+def encode_column(column, block_size):
+    # (palette, code width, packed codes, exceptions, exception offsets per
+    # block) for the cheapest code width, escapes included
+    column = np.asarray(column)
+    distinct, frequencies = np.unique(column, return_counts=True)
+    by_frequency = distinct[np.argsort(-frequencies, kind="stable")]
+    frequencies = np.sort(frequencies)[::-1]
+
+    def cost(width):
+        covered = min(len(distinct), (1 << width) - 1)
+        return width * len(column) + 8 * (len(column) - int(frequencies[:covered].sum()))
+
+    width = min(range(1, 9), key=cost)
+    palette = by_frequency[:min(len(distinct), (1 << width) - 1)]
+    escape = (1 << width) - 1
+    distinct_codes = np.full(len(distinct), escape, dtype=np.uint8)
+    distinct_codes[np.searchsorted(distinct, palette)] = np.arange(len(palette))
+    codes = distinct_codes[np.searchsorted(distinct, column)]
+    exceptional = codes == escape
+    exceptions = column[exceptional]
+    block_exceptions = np.add.reduceat(exceptional, np.arange(0, len(column), block_size)) if len(column) else []
+    offsets = np.concatenate([[0], np.cumsum(block_exceptions)]).astype(np.uint32)
+    bits = ((codes[:, None] >> np.arange(width)) & 1).astype(np.uint8)
+    return palette, width, np.packbits(bits.reshape(-1), bitorder="little"), exceptions, offsets
+
+
+def decode_codes(packed, width, begin, end):
+    # Codes begin..end of a packed column
+    first_bit = begin * width
+    data = np.asarray(packed[first_bit // 8:(end * width + 7) // 8])
+    bits = np.unpackbits(data, bitorder="little")[first_bit % 8:first_bit % 8 + (end - begin) * width]
+    return bits.reshape(-1, width) @ (1 << np.arange(width))
+
+
+def write_compressed(path, keys, values, moves=None, block_size=BLOCK_SIZE):
+    keys = np.asarray(keys, dtype=np.uint64)
+    count = len(keys)
+    block_starts = np.arange(0, count, block_size)
+    gaps = np.diff(keys)
+    # The gap into a block's first key is not stored, its index entry has the key
+    in_block = np.ones(len(gaps), dtype=bool)
+    in_block[block_starts[1:] - 1] = False
+    gaps = gaps[in_block]
+    # The gap into key i belongs to key i's block
+    gap_blocks = (np.flatnonzero(in_block) + 1) // block_size
+    block_bytes = np.bincount(gap_blocks, weights=varint_lengths(gaps), minlength=len(block_starts))
+    key_offsets = np.concatenate([[0], np.cumsum(block_bytes)])
+
+    columns = [encode_column(np.asarray(values, dtype=np.int8), block_size)]
+    if moves is not None:
+        columns.append(encode_column(np.asarray(moves, dtype=np.uint8), block_size))
+    value_palette, value_width = columns[0][:2]
+    move_palette, move_width = columns[1][:2] if moves is not None else (np.zeros(0, dtype=np.uint8), 0)
+
+    with open(path + ".tmp", "wb") as file:
+        file.write(COMPRESSED_HEADER.pack(COMPRESSED_MAGIC, count, block_size, len(block_starts),
+                                          value_width, len(value_palette), move_width, len(move_palette)))
+        file.write(value_palette.astype(np.int8).tobytes())
+        file.write(move_palette.astype(np.uint8).tobytes())
+        file.write(keys[block_starts].astype("<u8").tobytes())
+        file.write(key_offsets.astype("<u8").tobytes())
+        for _, _, _, _, offsets in columns:
+            file.write(offsets.astype("<u4").tobytes())
+        file.write(encode_varints(gaps).tobytes())
+        for _, _, packed, exceptions, _ in columns:
+            file.write(packed.tobytes())
+            file.write(exceptions.tobytes())
+    os.replace(path + ".tmp", path)
+
+
+class CompressedTable:
+    # Read-only view of a compressed table file that behaves like the memo
+    # dict. Only the header and index are read up front; blocks are decoded
+    # when looked up. Entries added during a live search go to an overlay.
+    def __init__(self, path):
+        self.path = path
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+        (magic, self.count, self.block_size, blocks, value_width, value_palette_size,
+         move_width, move_palette_size) = COMPRESSED_HEADER.unpack(bytes(data[:COMPRESSED_HEADER.size]))
+        if magic != COMPRESSED_MAGIC:
+            raise ValueError(f"{path} is not a Replace-TTT compressed table file")
+        offset = COMPRESSED_HEADER.size
+
+        def section(dtype, length):
+            nonlocal offset
+            size = np.dtype(dtype).itemsize * length
+            array = data[offset:offset + size].view(dtype)
+            offset += size
+            return array
+
+        value_palette = np.array(section(np.int8, value_palette_size))
+        move_palette = np.array(section(np.uint8, move_palette_size))
+        self.first_keys = np.array(section("<u8", blocks))
+        self.key_offsets = np.array(section("<u8", blocks + 1)).astype(np.int64)
+        value_offsets = np.array(section("<u4", blocks + 1)).astype(np.int64)
+        move_offsets = np.array(section("<u4", blocks + 1)).astype(np.int64) if move_width else None
+        self.key_stream = section(np.uint8, int(self.key_offsets[-1]))
+        self.columns = [(value_palette, value_width, section(np.uint8, (self.count * value_width + 7) // 8),
+                         section(np.int8, int(value_offsets[-1])), value_offsets)]
+        if move_width:
+            self.columns.append((move_palette, move_width, section(np.uint8, (self.count * move_width + 7) // 8),
+                                 section(np.uint8, int(move_offsets[-1])), move_offsets))
+        self.has_moves = bool(move_width)
+        self.block_cache = {}
+        self.overlay = {}
+
+    def decode_column(self, column, block, begin, end):
+        # Entries begin..end of a column, all in `block`, or all blocks when block is None
+        palette, width, packed, exceptions, offsets = column
+        codes = decode_codes(packed, width, begin, end)
+        escaped = codes == (1 << width) - 1
+        decoded = palette[np.minimum(codes, len(palette) - 1)] if len(palette) else np.zeros(len(codes), dtype=exceptions.dtype)
+        if block is None:
+            decoded[escaped] = exceptions
+        else:
+            decoded[escaped] = exceptions[offsets[block]:offsets[block + 1]]
+        return decoded
+
+    def decode_block(self, block, part=0):
+        # Keys (part 0), values (1) or moves (2) of one block, each decoded
+        # the first time it is asked for
+        cached = self.block_cache.get((block, part))
+        if cached is not None:
+            return cached
+        begin = block * self.block_size
+        end = min(begin + self.block_size, self.count)
+        if part == 0:
+            gaps = decode_varints(self.key_stream[self.key_offsets[block]:self.key_offsets[block + 1]])
+            decoded = self.first_keys[block] + np.concatenate([[0], np.cumsum(gaps)]).astype(np.uint64)
+        else:
+            decoded = self.decode_column(self.columns[part - 1], block, begin, end)
+        if len(self.block_cache) >= BLOCK_CACHE:
+            self.block_cache.clear()
+        self.block_cache[(block, part)] = decoded
+        return decoded
+
+    def find(self, key):
+        # (block, position in block) of `key`, or None
+        block = int(np.searchsorted(self.first_keys, np.uint64(key), side="right")) - 1
+        if block < 0:
+            return None
+        keys = self.decode_block(block)
+        position = int(np.searchsorted(keys, np.uint64(key)))
+        if position < len(keys) and keys[position] == key:
+            return block, position
+        return None
+
+    def __len__(self):
+        return self.count + len(self.overlay)
+
+    def get(self, key, default=None):
+        value = self.overlay.get(key)
+        if value is not None:
+            return value
+        found = self.find(key)
+        if found is None:
+            return default
+        block, position = found
+        return int(self.decode_block(block, 1)[position])
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.overlay[key] = value
+
+    def stored_move(self, key):
+        # Canonical best move code stored for `key`, or None
+        found = self.find(key) if self.has_moves else None
+        if found is None:
+            return None
+        block, position = found
+        move = int(self.decode_block(block, 2)[position])
+        return None if move == NO_MOVE else move
+
+    def lookup(self, keys):
+        # Vectorized get: (found mask, values), decoding each block the keys
+        # fall in once. Overlay entries are not consulted.
+        keys = np.asarray(keys, dtype=np.uint64)
+        found = np.zeros(len(keys), dtype=bool)
+        values = np.zeros(len(keys), dtype=np.int8)
+        blocks = np.searchsorted(self.first_keys, keys, side="right") - 1
+        order = np.argsort(blocks, kind="stable")
+        boundaries = np.flatnonzero(np.diff(blocks[order])) + 1
+        for group in np.split(order, boundaries):
+            if len(group) == 0 or blocks[group[0]] < 0:
+                continue
+            block = int(blocks[group[0]])
+            block_keys = self.decode_block(block)
+            positions = np.minimum(np.searchsorted(block_keys, keys[group]), len(block_keys) - 1)
+            hit = block_keys[positions] == keys[group]
+            found[group[hit]] = True
+            values[group[hit]] = self.decode_block(block, 1)[positions[hit]]
+        return found, values
+
+    def arrays(self, with_moves=False):
+        # Every key and value decoded at once, plus the stored moves when
+        # asked for; overlay entries have no move
+        gaps = decode_varints(self.key_stream)
+        block_starts = np.arange(0, self.count, self.block_size)
+        steps = np.zeros(self.count, dtype=np.uint64)
+        in_block = np.ones(self.count, dtype=bool)
+        in_block[block_starts] = False
+        steps[in_block] = gaps
+        # Gaps telescope, so their running total stays below the largest key
+        total = np.cumsum(steps)
+        block_of = np.arange(self.count) // self.block_size
+        keys = self.first_keys[block_of] + (total - total[block_starts][block_of])
+        columns = [keys] + [self.decode_column(column, None, 0, self.count) for column in self.columns]
+        if with_moves and not self.has_moves:
+            columns.append(np.full(self.count, NO_MOVE, dtype=np.uint8))
+        columns = columns[:3 if with_moves else 2]
+        if not self.overlay:
+            return tuple(columns)
+        overlay_keys = np.fromiter(self.overlay.keys(), dtype=np.uint64, count=len(self.overlay))
+        overlay_values = np.fromiter(self.overlay.values(), dtype=np.int8, count=len(self.overlay))
+        overlay_columns = [overlay_keys, overlay_values, np.full(len(self.overlay), NO_MOVE, dtype=np.uint8)]
+        order = np.argsort(np.concatenate([keys, overlay_keys]), kind="stable")
+        return tuple(np.concatenate([column, overlay_column])[order]
+                     for column, overlay_column in zip(columns, overlay_columns))
+
+
+def save_compressed(path, memo):
+    # Compress a memo dict or table backend, keeping its stored moves
+    write_compressed(path, *table_columns(memo))
+
+
+def main():
+    # python ReplaceTTTCompressed.py full_search_updated.tb full_search_updated.ctb
+    source, target = sys.argv[1:3]
+    table = load_table(source)
+    save_memo(target, table)
+    print("Compressed", len(table), "entries into", target)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+import glob
+import os
+import tempfile
+
+import numpy as np
+
+from ReplaceTTTTablebase import TABLE_EXTENSION, CompactTable, memo_lookup, merge_tables, save_memo, write_table
+
+# Spilled runs of an external-memory build are sorted compact tables (see
+# ReplaceTTTTablebase.py) in the spill directory
+RUN_PATTERN = "run_*" + TABLE_EXTENSION
+# What an entry held in memory costs: about 100 bytes in the dict, and 50
+# more for the arrays a spill sorts it in while the dict is still alive
+ENTRY_BYTES = 150
+# Bloom filter of each run: 10 bits and 7 hashes per entry, about 1% false positives
+BLOOM_BITS_PER_ENTRY = 10
+BLOOM_HASHES = 7
+BLOOM_CHUNK = 1 << 14
+# Entries held in memory never drop below this, however full the budget
+MIN_MEMORY_ENTRIES = 1 << 12
+HASH_MULTIPLIERS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F)
+HASH_MASK = (1 << 64) - 1
+
+
+class BloomFilter:
+    # Set of keys that can answer "maybe" for keys it does not hold, but
+    # never "no" for keys it does. Bit i of the filter is bit i % 8 of byte
+    # i // 8; a key sets BLOOM_HASHES bits by double hashing.
+    def __init__(self, keys):
+        self.size = max(8, len(keys) * BLOOM_BITS_PER_ENTRY)
+        keys = np.asarray(keys, dtype=np.uint64)
+        bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        # In chunks, so the positions do not cost more than the run being filtered
+        for begin in range(0, len(keys), BLOOM_CHUNK):
+            positions = self.positions(keys[begin:begin + BLOOM_CHUNK])
+            np.bitwise_or.at(bits, positions >> 3, (1 << (positions & 7)).astype(np.uint8))
+        self.bits = bytearray(bits.tobytes())
+
+    def positions(self, keys):
+        # (n, BLOOM_HASHES) bit positions; the hashes stay below 1 << 44 so
+        # this matches __contains__ without overflow
+        first = ((keys * np.uint64(HASH_MULTIPLIERS[0])) >> np.uint64(20)).astype(np.int64)
+        step = ((keys * np.uint64(HASH_MULTIPLIERS[1])) >> np.uint64(20)).astype(np.int64) | 1
+        return (first[:, None] + np.arange(BLOOM_HASHES) * step[:, None]) % self.size
+
+    def __contains__(self, key):
+        first = ((key * HASH_MULTIPLIERS[0]) & HASH_MASK) >> 20
+        step = (((key * HASH_MULTIPLIERS[1]) & HASH_MASK) >> 20) | 1
+        bits = self.bits
+        for index in range(BLOOM_HASHES):
+            position = (first + index * step) % self.size
+            if not (bits[position >> 3] >> (position & 7)) & 1:
+                return False
+        return True
+
+
+class SpillingMemo:
+    # Memo for a build under a RAM budget of `max_memory` bytes. New entries
+    # go to a dict; when it outgrows the budget, its entries are written to
+    # `directory` as a sorted run and it starts over. A lookup that misses
+    # the dict asks each run's Bloom filter and binary searches only the
+    # runs that might hold the key. The filters stay in memory and count
+    # against the budget, so later runs get smaller and the build slows
+    # down as it grows instead of running out of memory. With directory=None
+    # the runs go to a new temporary directory, which save() removes.
+    def __init__(self, directory, max_memory):
+        self.temporary = directory is None
+        if self.temporary:
+            directory = tempfile.mkdtemp(prefix="replacettt-spill-")
+        os.makedirs(directory, exist_ok=True)
+        if glob.glob(os.path.join(directory, RUN_PATTERN)):
+            raise ValueError(f"{directory} already holds spilled runs")
+        self.directory = directory
+        self.max_memory = max_memory
+        self.entries = {}
+        self.runs = []  # (CompactTable, BloomFilter) of each spilled run
+        self.spilled = 0
+        self.max_entries = self.memory_entries()
+
+    def memory_entries(self):
+        # Dict entries that fit next to the Bloom filters so far
+        filter_bytes = sum(len(bloom.bits) for _, bloom in self.runs)
+        return max(MIN_MEMORY_ENTRIES, (self.max_memory - filter_bytes) // ENTRY_BYTES)
+
+    def spill(self):
+        # Write the dict out as the next run
+        if not self.entries:
+            return
+        keys = np.fromiter(self.entries.keys(), dtype=np.uint64, count=len(self.entries))
+        values = np.fromiter(self.entries.values(), dtype=np.int8, count=len(self.entries))
+        order = np.argsort(keys)
+        # A temporary directory is gone after save() until the next run
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"run_{len(self.runs):06d}{TABLE_EXTENSION}")
+        write_table(path, keys[order], values[order])
+        self.runs.append((CompactTable(path), BloomFilter(keys)))
+        self.spilled += len(keys)
+        self.entries = {}
+        self.max_entries = self.memory_entries()
+
+    def __len__(self):
+        return len(self.entries) + self.spilled
+
+    def get(self, key, default=None):
+        value = self.entries.get(key)
+        if value is not None:
+            return value
+        for table, bloom in self.runs:
+            if key in bloom:
+                index = table.find(key)
+                if index >= 0:
+                    return int(table.values[index])
+        return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+        if len(self.entries) >= self.max_entries:
+            self.spill()
+
+    def update(self, memo):
+        for key, value in memo.items():
+            if key not in self:
+                self[key] = value
+
+    def stored_move(self, key):
+        return None
+
+    def lookup(self, keys):
+        # Vectorized get: (found mask, values)
+        found, values = memo_lookup(self.entries, keys)
+        for table, _ in self.runs:
+            missing = ~found
+            run_found, run_values = table.lookup(np.asarray(keys)[missing])
+            values[np.flatnonzero(missing)[run_found]] = run_values[run_found]
+            found[np.flatnonzero(missing)[run_found]] = True
+        return found, values
+
+    def run_paths(self):
+        return [table.path for table, _ in self.runs]
+
+    def arrays(self):
+        # Sorted keys and values of every entry, read into memory
+        self.spill()
+        keys = np.concatenate([np.asarray(table.keys) for table, _ in self.runs] or [np.zeros(0, dtype=np.uint64)])
+        values = np.concatenate([np.asarray(table.values) for table, _ in self.runs] or [np.zeros(0, dtype=np.int8)])
+        order = np.argsort(keys, kind="stable")
+        return keys[order], values[order]
+
+    def save(self, path, initial_counts=None):
+        # Spill what is left and k-way merge the runs into the table at
+        # `path`, then delete them, which leaves the memo empty. Only formats
+        # other than .tb are built in memory. Returns the number of entries.
+        self.spill()
+        table_path = path if path.endswith(TABLE_EXTENSION) else path + ".merge" + TABLE_EXTENSION
+        count = merge_tables(self.run_paths(), table_path)
+        if table_path != path:
+            save_memo(path, CompactTable(table_path), initial_counts)
+            os.remove(table_path)
+        for run_path in self.run_paths():
+            os.remove(run_path)
+        if self.temporary:
+            os.rmdir(self.directory)
+        self.runs = []
+        self.spilled = 0
+        self.max_entries = self.memory_entries()
+        return count
@@ -97,7 +97,7 @@ class ReplaceTTTGUI:
 
     def ai_move(self):
         # Make the best move for the AI
-        row, col, size = self.game.best_move()
+        row, col, size = self.game.player_move()
         self.game.make_move(row, col, size)
         self.update_board()
 
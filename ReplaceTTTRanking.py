@@ -0,0 +1,356 @@
+import os
+import struct
+
+import numpy as np
+
+from ReplaceTTTSolver import (
+    BOARD_MASK, CELL_SHIFTS, COUNT_SHIFTS, INITIAL_COUNTS, SIDE_SHIFT,
+    canonical_forms, pack_counts, pieces_left, unpack_counts
+)
+
+# Ranked table file: header, the canonical-board bitmap of the ranker, the
+# valid (composition, counts) pairs and then one int8 value per ranked state.
+# There are no keys: a state's position in the value array is its rank.
+RANKED_MAGIC = b"RTTTRK02"
+# Ranked tables from before values counted plies to the end
+LEGACY_RANKED_MAGIC = b"RTTTRK01"
+RANKED_HEADER = struct.Struct("<8sQQQQ")  # magic, initial counts, bitmap words, pairs, states
+MISSING = -128  # Value of ranked states that are not in the table
+
+# Board cells as symbols for the multiset ranking: empty, sX, mX, lX, sO, mO, lO
+SYMBOL_CODES = np.array([0, 1, 2, 3, 5, 6, 7], dtype=np.int64)
+CODE_SYMBOLS = np.array([0, 1, 2, 3, -1, 4, 5, 6], dtype=np.int64)
+# A board's composition word counts its pieces per (player, size), laid out
+# like the packed counts word
+SYMBOL_SHIFTS = [None] + COUNT_SHIFTS[0] + COUNT_SHIFTS[1]
+FACTORIALS = np.array([1, 1, 2, 6, 24, 120, 720, 5040, 40320, 362880], dtype=np.int64)
+BYTE_POPCOUNTS = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.int64)
+
+CHUNK_SIZE = 1 << 20
+
+
+def popcounts(words):
+    return BYTE_POPCOUNTS[np.asarray(words, dtype=np.uint64).view(np.uint8).reshape(-1, 8)].sum(axis=1)
+
+
+def symbol_counts(compositions):
+    # (7, n) pieces of each symbol on boards with these compositions
+    compositions = np.asarray(compositions, dtype=np.int64)
+    counts = [(compositions >> SYMBOL_SHIFTS[symbol]) & 3 for symbol in range(1, 7)]
+    return np.array([9 - sum(counts)] + counts)
+
+
+def valid_count_pairs(initial_counts):
+    # Every (composition, remaining counts) pair a game from `initial_counts`
+    # can reach, as sorted (composition << 12 | counts) words. Beyond the
+    # per-size bounds: large pieces are never lost, a lost medium needs an
+    # opposing large, every lost piece needs an opposing medium or large,
+    # and X has used as many pieces as O or one more.
+    initial = np.array([initial_counts[player][size] for player in "XO" for size in "sml"])
+    words = np.arange(4096, dtype=np.int64)
+    fields = np.array([(words >> shift) & 3 for shift in COUNT_SHIFTS[0] + COUNT_SHIFTS[1]])
+    in_inventory = (fields <= initial[:, None]).all(axis=0)
+
+    pairs = []
+    for composition in words[in_inventory & (fields.sum(axis=0) <= 9)]:
+        on_board = fields[:, composition][:, None]
+        remaining = fields[:, in_inventory]
+        used = initial[:, None] - remaining
+        lost = used - on_board
+        used_x, used_o = used[:3].sum(axis=0), used[3:].sum(axis=0)
+        valid = ((lost >= 0).all(axis=0) & (lost[2] == 0) & (lost[5] == 0) &
+                 (lost[1] <= used[5]) & (lost[4] <= used[2]) &
+                 (lost[0] + lost[1] <= used[4] + used[5]) &
+                 (lost[3] + lost[4] <= used[1] + used[2]) &
+                 ((used_x - used_o == 0) | (used_x - used_o == 1)))
+        pairs.append((composition << 12) | words[in_inventory][valid])
+    return np.concatenate(pairs).astype(np.uint32)
+
+
+class StateRanker:
+    # Dense ranking of canonical (board, counts) states; the side to move
+    # follows from the counts, so a key whose side bit disagrees is not
+    # ranked. States are ordered by board composition, then by canonical
+    # board, then by remaining counts, so
+    #   rank = state_base[comp] + canonical_index * pair_count[comp] + counts_index
+    # canonical_index comes from a rank/select bitmap over every board with that
+    # composition, each board numbered by its multiset permutation rank.
+    def __init__(self, initial_counts=INITIAL_COUNTS, bitmap=None, pairs=None):
+        self.initial_counts = initial_counts
+        self.total = sum(count for sizes in initial_counts.values() for count in sizes.values())
+        self.pairs = valid_count_pairs(initial_counts) if pairs is None else np.asarray(pairs)
+        pair_compositions = self.pairs.astype(np.int64) >> 12
+        compositions = np.unique(pair_compositions)
+
+        self.composition_valid = np.zeros(4096, dtype=bool)
+        self.composition_valid[compositions] = True
+        counts = symbol_counts(compositions)
+        self.multinomials = np.zeros(4096, dtype=np.int64)
+        self.multinomials[compositions] = FACTORIALS[9] // np.prod(FACTORIALS[counts], axis=0)
+        self.board_base = np.zeros(4096, dtype=np.int64)
+        self.board_base[compositions] = np.cumsum(self.multinomials[compositions]) - self.multinomials[compositions]
+        self.board_total = int(self.multinomials.sum())
+        self.compositions = compositions
+
+        self.pair_first = np.zeros(4096, dtype=np.int64)
+        self.pair_count = np.zeros(4096, dtype=np.int64)
+        self.pair_first[compositions] = np.searchsorted(pair_compositions, compositions)
+        self.pair_count[compositions] = np.searchsorted(pair_compositions, compositions, side="right") - self.pair_first[compositions]
+        self.pair_index = {int(pair): index for index, pair in enumerate(self.pairs.tolist())}
+
+        self.bitmap = self.build_bitmap() if bitmap is None else np.asarray(bitmap)
+        word_counts = popcounts(self.bitmap)
+        self.directory = np.cumsum(word_counts) - word_counts  # Set bits before each word
+        canonical_before = self.rank_bits(self.board_base[compositions])
+        canonical_after = self.rank_bits(self.board_base[compositions] + self.multinomials[compositions])
+        self.canonical_base = np.zeros(4096, dtype=np.int64)
+        self.canonical_base[compositions] = canonical_before
+        sizes = (canonical_after - canonical_before) * self.pair_count[compositions]
+        self.state_base = np.zeros(4096, dtype=np.int64)
+        self.state_base[compositions] = np.cumsum(sizes) - sizes
+        self.size = int(sizes.sum())
+        self.state_ends = self.state_base[compositions] + sizes
+
+    def board_positions(self, boards):
+        # Composition and global multiset rank of each board code; the rank is
+        # -1 for boards holding more pieces than the inventory allows
+        boards = np.asarray(boards, dtype=np.int64)
+        symbols = np.array([CODE_SYMBOLS[(boards >> shift) & 7] for shift in CELL_SHIFTS])
+        counts = np.array([(symbols == symbol).sum(axis=0) for symbol in range(7)])
+        compositions = np.zeros(len(boards), dtype=np.int64)
+        for symbol in range(1, 7):
+            compositions |= np.minimum(counts[symbol], 3) << SYMBOL_SHIFTS[symbol]
+        valid = self.composition_valid[compositions] & (counts[1:] <= 3).all(axis=0) & (symbols >= 0).all(axis=0)
+
+        multinomial = FACTORIALS[9] // np.prod(FACTORIALS[counts], axis=0)
+        ranks = np.zeros(len(boards), dtype=np.int64)
+        columns = np.arange(len(boards))
+        for cell, remaining in enumerate(range(9, 0, -1)):
+            symbol = symbols[cell]
+            for smaller in range(6):
+                ranks += np.where(smaller < symbol, multinomial * counts[smaller] // remaining, 0)
+            multinomial = multinomial * counts[symbol, columns] // remaining
+            counts[symbol, columns] -= 1
+        return compositions, np.where(valid, self.board_base[compositions] + ranks, -1)
+
+    def boards_at(self, compositions, positions):
+        # Inverse of board_positions
+        ranks = positions - self.board_base[compositions]
+        counts = symbol_counts(compositions)
+        multinomial = self.multinomials[compositions].copy()
+        columns = np.arange(len(compositions))
+        boards = np.zeros(len(compositions), dtype=np.int64)
+        for remaining in range(9, 0, -1):
+            chosen = np.full(len(compositions), -1, dtype=np.int64)
+            for symbol in range(7):
+                block = multinomial * counts[symbol] // remaining
+                take = (chosen < 0) & (ranks < block)
+                chosen[take] = symbol
+                ranks -= np.where((chosen < 0), block, 0)
+            multinomial = multinomial * counts[chosen, columns] // remaining
+            counts[chosen, columns] -= 1
+            boards = (boards << 3) | SYMBOL_CODES[chosen]
+        return boards
+
+    def build_bitmap(self):
+        # Mark the canonical boards among all board positions
+        bitmap = np.zeros((self.board_total + 63) // 64, dtype=np.uint64)
+        composition_starts = self.board_base[self.compositions]
+        for begin in range(0, self.board_total, CHUNK_SIZE):
+            positions = np.arange(begin, min(begin + CHUNK_SIZE, self.board_total), dtype=np.int64)
+            compositions = self.compositions[np.searchsorted(composition_starts, positions, side="right") - 1]
+            boards = self.boards_at(compositions, positions)
+            canonical, _ = canonical_forms(boards)
+            marked = positions[canonical == boards]
+            np.bitwise_or.at(bitmap, marked >> 6, np.uint64(1) << (marked & 63).astype(np.uint64))
+        return bitmap
+
+    def rank_bits(self, positions):
+        # Set bits of the bitmap before each position
+        positions = np.asarray(positions, dtype=np.int64)
+        words = positions >> 6
+        in_range = words < len(self.bitmap)
+        words = np.where(in_range, words, 0)
+        below = (np.uint64(1) << (positions & 63).astype(np.uint64)) - np.uint64(1)
+        ranks = self.directory[words] + popcounts(self.bitmap[words] & below)
+        return np.where(in_range, ranks, self.directory[-1] + popcounts(self.bitmap[-1:])[0])
+
+    def select_bits(self, ranks):
+        # Position of the rank-th set bit of the bitmap
+        words = np.searchsorted(self.directory, ranks, side="right") - 1
+        wanted = ranks - self.directory[words]
+        values = self.bitmap[words]
+        positions = np.full(len(ranks), -1, dtype=np.int64)
+        for bit in range(64):
+            is_set = ((values >> np.uint64(bit)) & np.uint64(1)).astype(bool)
+            hit = is_set & (wanted == 0) & (positions < 0)
+            positions[hit] = bit
+            wanted -= is_set
+        return (words << 6) + positions
+
+    def rank(self, keys):
+        # Dense index of each state key, -1 for keys outside the ranked space
+        keys = np.asarray(keys, dtype=np.int64)
+        compositions, positions = self.board_positions((keys >> 12) & BOARD_MASK)
+        valid = (positions >= 0) & (keys >> SIDE_SHIFT == self.side_to_move(keys & 0xFFF))
+        positions = np.where(valid, positions, 0)
+        words = self.bitmap[positions >> 6]
+        valid &= ((words >> (positions & 63).astype(np.uint64)) & np.uint64(1)).astype(bool)
+
+        pairs = ((compositions << 12) | (keys & 0xFFF)).astype(np.uint32)
+        pair_index = np.minimum(np.searchsorted(self.pairs, pairs), len(self.pairs) - 1)
+        valid &= self.pairs[pair_index] == pairs
+
+        canonical_index = self.rank_bits(positions) - self.canonical_base[compositions]
+        ranks = (self.state_base[compositions] + canonical_index * self.pair_count[compositions] +
+                 pair_index - self.pair_first[compositions])
+        return np.where(valid, ranks, -1)
+
+    def rank_one(self, key):
+        # Scalar rank for lookups during search, avoiding per-call array overhead
+        board = (key >> 12) & BOARD_MASK
+        if key >> SIDE_SHIFT != self.side_to_move(key & 0xFFF):
+            return -1
+        symbols = [int(CODE_SYMBOLS[(board >> shift) & 7]) for shift in CELL_SHIFTS]
+        counts = [symbols.count(symbol) for symbol in range(7)]
+        if -1 in symbols or max(counts[1:]) > 3:
+            return -1
+        composition = sum(counts[symbol] << SYMBOL_SHIFTS[symbol] for symbol in range(1, 7))
+        pair = self.pair_index.get((composition << 12) | (key & 0xFFF))
+        if pair is None:
+            return -1
+
+        multinomial = int(self.multinomials[composition])
+        rank = 0
+        for remaining, symbol in zip(range(9, 0, -1), symbols):
+            for smaller in range(symbol):
+                rank += multinomial * counts[smaller] // remaining
+            multinomial = multinomial * counts[symbol] // remaining
+            counts[symbol] -= 1
+        position = int(self.board_base[composition]) + rank
+        word = int(self.bitmap[position >> 6])
+        bit = position & 63
+        if not (word >> bit) & 1:
+            return -1
+        canonical_index = int(self.directory[position >> 6]) + (word & ((1 << bit) - 1)).bit_count() - int(self.canonical_base[composition])
+        return (int(self.state_base[composition]) + canonical_index * int(self.pair_count[composition]) +
+                pair - int(self.pair_first[composition]))
+
+    def unrank(self, ranks):
+        # State key at each dense index
+        ranks = np.asarray(ranks, dtype=np.int64)
+        compositions = self.compositions[np.searchsorted(self.state_ends, ranks, side="right")]
+        canonical_index, pair_offset = np.divmod(ranks - self.state_base[compositions], self.pair_count[compositions])
+        positions = self.select_bits(self.canonical_base[compositions] + canonical_index)
+        boards = self.boards_at(compositions, positions)
+        counts = self.pairs[self.pair_first[compositions] + pair_offset].astype(np.int64) & 0xFFF
+        return (self.side_to_move(counts) << SIDE_SHIFT) | (boards << 12) | counts
+
+    def side_to_move(self, counts):
+        # 0 for X, 1 for O, from packed counts (an int or an array)
+        return (self.total - pieces_left(counts)) & 1
+
+
+class RankedTable:
+    # Memo backend keeping one int8 per ranked state and no keys. Missing
+    # entries hold MISSING; writes to a read-only file go to an overlay.
+    def __init__(self, ranker, values=None):
+        self.ranker = ranker
+        self.values = np.full(ranker.size, MISSING, dtype=np.int8) if values is None else values
+        self.overlay = {}
+
+    @classmethod
+    def from_memo(cls, memo, initial_counts=INITIAL_COUNTS, ranker=None):
+        keys = np.fromiter(memo.keys(), dtype=np.int64, count=len(memo))
+        values = np.fromiter(memo.values(), dtype=np.int8, count=len(memo))
+        return cls.from_arrays(keys, values, initial_counts, ranker)
+
+    @classmethod
+    def from_arrays(cls, keys, values, initial_counts=INITIAL_COUNTS, ranker=None):
+        table = cls(ranker or StateRanker(initial_counts))
+        keys = np.asarray(keys, dtype=np.int64)
+        values = np.asarray(values, dtype=np.int8)
+        ranks = table.ranker.rank(keys)
+        table.values[ranks[ranks >= 0]] = values[ranks >= 0]
+        table.overlay.update(zip(keys[ranks < 0].tolist(), values[ranks < 0].tolist()))
+        return table
+
+    @classmethod
+    def open(cls, path):
+        with open(path, "rb") as file:
+            magic, packed_counts, words, pair_count, size = RANKED_HEADER.unpack(file.read(RANKED_HEADER.size))
+            if magic == LEGACY_RANKED_MAGIC:
+                raise ValueError(f"{path} holds depth-relative values; rebuild it with ReplaceTTTBuild.py")
+            if magic != RANKED_MAGIC:
+                raise ValueError(f"{path} is not a Replace-TTT ranked table file")
+            bitmap = np.frombuffer(file.read(8 * words), dtype="<u8")
+            pairs = np.frombuffer(file.read(4 * pair_count), dtype="<u4")
+        ranker = StateRanker(unpack_counts(packed_counts), bitmap=bitmap, pairs=pairs)
+        offset = RANKED_HEADER.size + 8 * words + 4 * pair_count
+        return cls(ranker, np.memmap(path, dtype=np.int8, mode="r", offset=offset, shape=(size,)))
+
+    def save(self, path):
+        values = np.array(self.values)
+        overlay = {}
+        for key, value in self.overlay.items():
+            rank = self.ranker.rank_one(key)
+            if rank >= 0:
+                values[rank] = value
+            else:
+                overlay[key] = value
+        if overlay:
+            raise ValueError(f"{len(overlay)} entries are outside the ranked state space")
+        with open(path + ".tmp", "wb") as file:
+            file.write(RANKED_HEADER.pack(RANKED_MAGIC, pack_counts(self.ranker.initial_counts),
+                                          len(self.ranker.bitmap), len(self.ranker.pairs), self.ranker.size))
+            file.write(self.ranker.bitmap.astype("<u8").tobytes())
+            file.write(self.ranker.pairs.astype("<u4").tobytes())
+            file.write(values.tobytes())
+        os.replace(path + ".tmp", path)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.values != MISSING)) + len(self.overlay)
+
+    def get(self, key, default=None):
+        value = self.overlay.get(key)
+        if value is not None:
+            return value
+        rank = self.ranker.rank_one(key)
+        if rank < 0:
+            return default
+        value = int(self.values[rank])
+        return default if value == MISSING else value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        rank = self.ranker.rank_one(key)
+        if rank >= 0 and self.values.flags.writeable:
+            self.values[rank] = value
+        else:
+            self.overlay[key] = value
+
+    def lookup(self, keys):
+        # Vectorized get: (found mask, values); overlay entries are not consulted
+        ranks = self.ranker.rank(keys)
+        values = np.where(ranks >= 0, self.values[np.maximum(ranks, 0)], MISSING).astype(np.int8)
+        found = values != MISSING
+        return found, np.where(found, values, 0).astype(np.int8)
+
+    def arrays(self):
+        # Sorted keys and values of every stored state, for converting to other formats
+        ranks = np.flatnonzero(np.asarray(self.values) != MISSING)
+        keys = self.ranker.unrank(ranks).astype(np.uint64)
+        values = np.asarray(self.values)[ranks]
+        if self.overlay:
+            keys = np.concatenate([keys, np.fromiter(self.overlay.keys(), dtype=np.uint64, count=len(self.overlay))])
+            values = np.concatenate([values, np.fromiter(self.overlay.values(), dtype=np.int8, count=len(self.overlay))])
+        order = np.argsort(keys, kind="stable")
+        return keys[order], values[order]
@@ -0,0 +1,289 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from ReplaceTTTAnalysis import ILLEGAL, NO_BEST_MOVE, evaluate_chunk
+from ReplaceTTTBuild import total_pieces
+from ReplaceTTTRanking import CODE_SYMBOLS, SYMBOL_SHIFTS, valid_count_pairs
+from ReplaceTTTSolver import CELL_SHIFTS, COUNT_SHIFTS, INITIAL_COUNTS, MOVE_TUPLES, TicTacToe, pack_counts, pieces_left
+
+# Requests answered together at most, and how long the first one of a batch
+# waits for others to join it. Requests that arrive while a batch is being
+# evaluated make up the next one anyway, so by default it only yields once
+# to the event loop.
+BATCH_SIZE = 1024
+BATCH_WINDOW = 0
+# Latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+OPERATIONS = ("best_move", "evaluate", "stats")
+
+
+class MoveServer:
+    # One warm engine answering many clients. Requests are JSON objects with
+    # an "op", an optional "id" echoed back, and for best_move and evaluate a
+    # position as its 27-bit "board" code and packed "counts" (a game's
+    # symmetry_hashes[0] and packed_counts):
+    #   {"id": 1, "op": "best_move", "board": 0, "counts": 4030}
+    #   -> {"id": 1, "move": [0, 0, "m"], "value": 91}
+    #   {"id": 2, "op": "evaluate", "board": 0, "counts": 4030}
+    #   -> {"id": 2, "value": 91, "best_move": [0, 0, "m"], "move_values": [27 values, null if illegal]}
+    #   {"op": "stats"} -> {"requests": ..., "batches": ..., "p50_ms": ..., "p99_ms": ...}
+    # A finished position has no move. best_move answers with the move
+    # TicTacToe.best_move would pick. Positions waiting at the same time are
+    # evaluated as one batch with vectorized table lookups, on a worker
+    # thread so the event loop keeps reading requests meanwhile.
+    def __init__(self, memo_file_path="full_search_updated.tb", initial_counts=INITIAL_COUNTS,
+                 batch_size=BATCH_SIZE, batch_window=BATCH_WINDOW):
+        self.game = TicTacToe(initial_counts=initial_counts, memo_file_path=memo_file_path)
+        if memo_file_path:
+            # Load the table now rather than on the first request
+            self.game.memo.table
+        self.total = total_pieces(initial_counts)
+        # For turning away positions no game reaches, whose search the table
+        # cannot answer: a game of the request thread's own to check with,
+        # and every (board composition, counts) pair the inventory allows
+        self.checker = TicTacToe(initial_counts=initial_counts, memo_file_path=memo_file_path)
+        self.has_table = bool(memo_file_path) and len(self.game.memo) > 0
+        self.inventory = [initial_counts[player][size] for player in "XO" for size in "sml"]
+        self.count_pairs = set(valid_count_pairs(initial_counts).tolist())
+        self.start_counts = pack_counts(initial_counts)
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.queue = None
+        self.batcher = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.requests = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def start(self):
+        # Start batching on the running event loop
+        if self.batcher is None:
+            self.queue = asyncio.Queue()
+            self.batcher = asyncio.get_running_loop().create_task(self.run_batches())
+
+    async def close(self):
+        if self.batcher is not None:
+            self.batcher.cancel()
+            try:
+                await self.batcher
+            except asyncio.CancelledError:
+                pass
+            self.batcher = None
+        self.executor.shutdown()
+
+    async def run_batches(self):
+        # Take the first waiting request, give others batch_window to join
+        # it, then answer everything queued by then
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            if self.queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.batch_window)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            requests = [request for request, _ in batch]
+            try:
+                responses = await loop.run_in_executor(self.executor, self.evaluate_batch, requests)
+            except Exception as error:
+                responses = [{"error": str(error)} for _ in requests]
+            self.batches += 1
+            for (_, future), response in zip(batch, responses):
+                if not future.done():
+                    future.set_result(response)
+
+    def evaluate_batch(self, requests):
+        # Responses to checked best_move and evaluate requests. A best_move
+        # whose position has a stored move and value is answered with two
+        # lookups; every other position is evaluated in one vectorized batch.
+        game = self.game
+        responses = [None] * len(requests)
+        pending = []
+        for position, request in enumerate(requests):
+            if request["op"] == "best_move":
+                game.load_position(request["board"], request["counts"])
+                stored = game.stored_move()
+                value = game.memo.get(game.encoded_game_state()) if stored is not None else None
+                if value is not None:
+                    responses[position] = {"move": list(stored), "value": value}
+                    continue
+            pending.append(position)
+        if not pending:
+            return responses
+
+        boards = np.array([requests[position]["board"] for position in pending], dtype=np.int64)
+        counts = np.array([requests[position]["counts"] for position in pending], dtype=np.int64)
+        sides = (self.total - pieces_left(counts)) & 1
+        values = np.zeros(len(pending), dtype=np.int8)
+        best_moves = np.full(len(pending), NO_BEST_MOVE, dtype=np.int8)
+        move_values = np.zeros((len(pending), len(MOVE_TUPLES)), dtype=np.int8)
+        for side in (0, 1):
+            index = np.flatnonzero(sides == side)
+            if len(index):
+                values[index], best_moves[index], move_values[index] = evaluate_chunk(
+                    game, boards[index], counts[index], side)
+
+        for batch_index, position in enumerate(pending):
+            move = int(best_moves[batch_index])
+            # evaluate_chunk keeps the first best move in get_valid_moves
+            # order, which is best_move's pick when nothing is stored
+            best = list(MOVE_TUPLES[move]) if move != NO_BEST_MOVE else None
+            if requests[position]["op"] == "best_move":
+                responses[position] = {"move": best, "value": int(values[batch_index])}
+            else:
+                responses[position] = {
+                    "value": int(values[batch_index]), "best_move": best,
+                    "move_values": [None if value == ILLEGAL else int(value) for value in move_values[batch_index]],
+                }
+        return responses
+
+    def check_request(self, request):
+        # Error message for a malformed request, or None
+        if not isinstance(request, dict) or request.get("op") not in OPERATIONS:
+            return f"op must be one of {', '.join(OPERATIONS)}"
+        if request["op"] == "stats":
+            return None
+        board = request.get("board")
+        counts = request.get("counts")
+        # type() rather than isinstance(), which would take true and false
+        if type(board) is not int or type(counts) is not int or not 0 <= board < 1 << 27 or not 0 <= counts < 1 << 12:
+            return "board must be a 27-bit board code and counts 12-bit packed counts"
+        return self.check_position(board, counts)
+
+    def check_position(self, board, counts):
+        # Error message for a position no game from the inventory reaches,
+        # or None. With a table, a reachable position is the start, a
+        # finished game or one of its entries, so a request never leaves the
+        # worker thread searching live.
+        symbols = [int(CODE_SYMBOLS[(board >> shift) & 7]) for shift in CELL_SHIFTS]
+        if -1 in symbols:
+            return "cell codes must be 0 (empty), 1-3 (X small to large) or 5-7 (O small to large)"
+        if any((counts >> shift) & 3 > count for shift, count in zip(COUNT_SHIFTS[0] + COUNT_SHIFTS[1], self.inventory)):
+            return "counts hold more pieces than the inventory"
+        pieces = [symbols.count(symbol) for symbol in range(7)]
+        composition = sum(min(pieces[symbol], 3) << SYMBOL_SHIFTS[symbol] for symbol in range(1, 7))
+        if max(pieces[1:]) > 3 or (composition << 12) | counts not in self.count_pairs:
+            return "no game reaches this board with these counts"
+        if self.has_table and not (board == 0 and counts == self.start_counts):
+            self.checker.load_position(board, counts)
+            if self.checker.check_game_over() is None and self.checker.encoded_game_state() not in self.checker.memo:
+                return "no game reaches this position"
+        return None
+
+    async def answer(self, request):
+        # Response to one decoded request
+        start = time.perf_counter()
+        error = self.check_request(request)
+        if error is not None:
+            response = {"error": error}
+        elif request["op"] == "stats":
+            response = self.stats()
+        else:
+            self.start()
+            future = asyncio.get_running_loop().create_future()
+            await self.queue.put((request, future))
+            response = await future
+            self.requests += 1
+            self.latencies.append(time.perf_counter() - start)
+        if isinstance(request, dict) and "id" in request:
+            response = {"id": request["id"], **response}
+        return response
+
+    async def answer_line(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return json.dumps({"error": "request is not valid JSON"})
+        return json.dumps(await self.answer(request))
+
+    def stats(self):
+        # Requests and batches so far, with latency percentiles in milliseconds
+        # over the last LATENCY_WINDOW requests
+        latencies = np.array(self.latencies) * 1000
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+            "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+        }
+
+    async def serve_lines(self, read_line, write_line):
+        # Answer one client's JSON lines as they come, each on its own task,
+        # so answers can come back out of order; clients match them by id
+        tasks = set()
+
+        async def respond(line):
+            await write_line(await self.answer_line(line))
+
+        while True:
+            line = await read_line()
+            if not line:
+                break
+            if line.strip():
+                task = asyncio.create_task(respond(line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def serve_stream(self, reader, writer):
+        async def write_line(text):
+            writer.write((text + "\n").encode())
+            await writer.drain()
+
+        await self.serve_lines(reader.readline, write_line)
+        writer.close()
+
+    async def serve_unix(self, path):
+        self.start()
+        server = await asyncio.start_unix_server(self.serve_stream, path=path)
+        async with server:
+            await server.serve_forever()
+
+    async def serve_stdio(self):
+        # Serve one client on stdin and stdout until stdin closes. stdin is
+        # read on a thread, which works for files and terminals as well as pipes.
+        self.start()
+        loop = asyncio.get_running_loop()
+
+        async def write_line(text):
+            sys.stdout.write(text + "\n")
+            sys.stdout.flush()
+
+        await self.serve_lines(lambda: loop.run_in_executor(None, sys.stdin.readline), write_line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer Replace-TTT move requests from one warm engine")
+    parser.add_argument("--table", default="full_search_updated.tb", help="table to load, any format")
+    parser.add_argument("--socket", default=None, help="listen on this Unix socket instead of stdin/stdout")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="most requests answered together")
+    parser.add_argument("--batch-window-ms", type=float, default=BATCH_WINDOW * 1000,
+                        help="how long a request waits for others to batch with")
+    args = parser.parse_args()
+
+    server = MoveServer(args.table, batch_size=args.batch_size, batch_window=args.batch_window_ms / 1000)
+
+    async def serve():
+        try:
+            if args.socket:
+                await server.serve_unix(args.socket)
+            else:
+                await server.serve_stdio()
+        finally:
+            print(json.dumps(server.stats()), file=sys.stderr)
+            await server.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import sys
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from ReplaceTTTTablebase import (
+    SHARED_MEMORY_PREFIX, TABLE_HEADER, TABLE_MAGIC, TABLE_MOVES_MAGIC, CompactTable, SharedTable, load_table,
+    table_columns
+)
+
+
+class SharedMemoryBlock(SharedMemory):
+    # The table's arrays view the block until they are collected, which at
+    # interpreter exit can be after the block; the OS unmaps it either way
+    def __del__(self):
+        try:
+            self.close()
+        except BufferError:
+            pass
+
+
+def attach_block(name):
+    # Attach to an existing block without a resource tracker of this
+    # process's own taking it on, which would unlink the block when this
+    # process exits. Before 3.13 attaching registers the block too. Workers
+    # forked or spawned from the creator share its tracker, where the block
+    # is already registered, so only a process that has no tracker yet, one
+    # not started from the creator, unregisters it again.
+    if sys.version_info >= (3, 13):
+        return SharedMemoryBlock(name=name, track=False)
+    own_tracker = resource_tracker._resource_tracker._fd is None
+    memory = SharedMemoryBlock(name=name)
+    if own_tracker:
+        resource_tracker.unregister(memory._name, "shared_memory")
+    return memory
+
+
+class SharedMemoryTable(CompactTable):
+    # Compact table whose bytes live in a multiprocessing shared memory block
+    # instead of a file, in the same layout. One process places a table there
+    # with create(); workers attach to it by name, or open its path
+    # "shm:<name>" wherever a table path is taken (TicTacToe(memo_file_path=...),
+    # evaluate_positions, verify_table). Every process maps the same pages
+    # read-only and Python objects never point into them, so nothing is
+    # copied on write and the table costs the same however many workers use it.
+    # The creating process has to outlive its workers and unlink the block.
+    def __init__(self, name, memory=None):
+        self.memory = memory if memory is not None else attach_block(name)
+        self.owner = memory is not None
+        super().__init__(SHARED_MEMORY_PREFIX + self.memory.name, self.memory.buf)
+
+    @classmethod
+    def create(cls, memo, name=None):
+        # Copy a memo dict, table backend or table path into a new shared
+        # memory block, keeping stored moves
+        if isinstance(memo, str):
+            memo = load_table(memo)
+        if isinstance(memo, SharedTable):
+            memo = memo.table
+        keys, values, moves = table_columns(memo)
+        count = len(keys)
+        size = TABLE_HEADER.size + (9 if moves is None else 10) * count
+        memory = SharedMemoryBlock(name=name, create=True, size=size)
+        TABLE_HEADER.pack_into(memory.buf, 0, TABLE_MAGIC if moves is None else TABLE_MOVES_MAGIC, count)
+        columns = [(keys, "<u8", TABLE_HEADER.size), (values, np.int8, TABLE_HEADER.size + 8 * count)]
+        if moves is not None:
+            columns.append((moves, np.uint8, TABLE_HEADER.size + 9 * count))
+        for column, dtype, offset in columns:
+            np.frombuffer(memory.buf, dtype=dtype, count=count, offset=offset)[:] = column
+        return cls(memory.name, memory)
+
+    def close(self):
+        # Detach this process; the arrays viewing the block go with it
+        self.keys = self.values = self.moves = None
+        self.memory.close()
+
+    def unlink(self):
+        # Detach and free the block, for the creating process once its workers are done
+        self.close()
+        self.memory.unlink()
+
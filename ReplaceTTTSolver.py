@@ -1,29 +1,361 @@
-import pickle
-import os
+import functools
 import time
+from operator import add
+
+import numpy as np
+
+from ReplaceTTTCheckpoint import CHECKPOINT_ENTRIES, CHECKPOINT_SECONDS, CheckpointedMemo
+from ReplaceTTTExternal import SpillingMemo
+from ReplaceTTTTablebase import save_memo, shared_table
+from ReplaceTTTTransposition import TranspositionTable
+
+# Bitboard layout: cell index = row * 3 + col, bit (1 << cell) in every mask.
+# A cell code packs a piece the same way encoded_board does: bit 2 is the
+# owner (0 = X, 1 = O) and the low two bits are the size (1 = s, 2 = m, 3 = l).
+PLAYERS = "XO"
+SIZES = "sml"
+SIZE_INDEX = {"s": 0, "m": 1, "l": 2}
+FULL_BOARD = 0b111111111
+CELL_ROW_COL = [(cell // 3, cell % 3) for cell in range(9)]
+PIECE_STRINGS = [" ", "sX", "mX", "lX", None, "sO", "mO", "lO"]
+PIECE_CODES = {piece: code for code, piece in enumerate(PIECE_STRINGS) if piece is not None}
+
+# Lines in the order check_connect_3 has always scanned them: rows, columns, diagonals
+LINES = [
+    0b000000111, 0b000111000, 0b111000000,
+    0b001001001, 0b010010010, 0b100100100,
+    0b100010001, 0b001010100
+]
+
+# Bit offset of each (player, size) count inside the packed counts word.
+# The word is laid out like encoded_counts: Xs Xm Xl Os Om Ol, 2 bits each.
+COUNT_SHIFTS = [[10, 8, 6], [4, 2, 0]]
+INITIAL_COUNTS = {
+    "X": {"s": 3, "m": 3, "l": 2},
+    "O": {"s": 3, "m": 3, "l": 2}
+}
+
+# How long the CLI and GUI players think when no table is loaded; a full
+# live search from an early position takes minutes
+PLAYER_TIME_BUDGET_MS = 2000
+
+# Flags of alpha-beta entries in TicTacToe.bounds
+LOWER_BOUND = 1
+UPPER_BOUND = 2
+
+# Values count plies to the end of the game, not from the search root: an X
+# win n plies ahead is WIN - n, an O win n - WIN, a draw 0. A stored value so
+# holds for the position whatever depth it is reached at. Values past DECIDED
+# are decided games; heuristic estimates stay inside (-1, 1).
+WIN = 100
+DECIDED = 50
+
+# State keys: side to move << SIDE_SHIFT | canonical board << 12 | packed counts
+SIDE_SHIFT = 39
+BOARD_MASK = (1 << 27) - 1
+
+# Symmetries of the board as index mappings: transformed cell k takes
+# cell TRANSFORMATIONS[t][k] of the original board
+TRANSFORMATIONS = [
+    [0, 1, 2,   # Original
+    3, 4, 5,
+    6, 7, 8],
+
+    [6, 3, 0,   # 90° Rotation
+    7, 4, 1,
+    8, 5, 2],
+
+    [8, 7, 6,   # 180° Rotation
+    5, 4, 3,
+    2, 1, 0],
+
+    [2, 5, 8,   # 270° Rotation
+    1, 4, 7,
+    0, 3, 6],
+
+    [2, 1, 0,   # Horizontal Flip
+    5, 4, 3,
+    8, 7, 6],
+
+    [6, 7, 8,   # Vertical Flip
+    3, 4, 5,
+    0, 1, 2],
+
+    [0, 3, 6,   # Diagonal (\) Flip
+    1, 4, 7,
+    2, 5, 8],
+
+    [8, 5, 2,   # Diagonal (/) Flip
+    7, 4, 1,
+    6, 3, 0]
+]
+
+# Shift of each cell inside a 27-bit board code (cell 0 is the most significant)
+CELL_SHIFTS = [3 * (8 - cell) for cell in range(9)]
+
+# SYMMETRY_DELTAS[cell][old][new] holds, for every transformation, what
+# changing `cell` from code `old` to code `new` adds to that transformed code
+SYMMETRY_DELTAS = [
+    [
+        [
+            [(new - old) << CELL_SHIFTS[transformation.index(cell)] for transformation in TRANSFORMATIONS]
+            for new in range(8)
+        ]
+        for old in range(8)
+    ]
+    for cell in range(9)
+]
+
+# Lookup tables for batch canonicalization. A 27-bit board code is split into
+# three 9-bit chunks (one board row each); CHUNK_TABLES[t, j, v] is what row j
+# holding chunk value v contributes to the code under transformation t.
+def build_chunk_tables():
+    chunk_values = np.arange(512, dtype=np.int64)
+    tables = np.zeros((len(TRANSFORMATIONS), 3, 512), dtype=np.int64)
+    for t, transformation in enumerate(TRANSFORMATIONS):
+        for cell in range(9):
+            codes = (chunk_values >> (3 * (2 - cell % 3))) & 7
+            tables[t, cell // 3] |= codes << CELL_SHIFTS[transformation.index(cell)]
+    return tables
+
+CHUNK_TABLES = build_chunk_tables()
+
+
+# Moves as ints: move = cell * 3 + size index, so counting up through the set
+# bits of a move mask visits the moves in get_valid_moves order
+MOVE_TUPLES = [(cell // 3, cell % 3, SIZES[size]) for cell in range(9) for size in range(3)]
+
+# Shift of the side to move's three counts inside the packed counts, and the
+# sizes still in hand (bit per size index) for each value of those 6 bits
+HAND_SHIFTS = [6, 0]
+AVAILABLE_SIZES = [
+    sum(1 << size for size in range(3) if (hand >> (4 - 2 * size)) & 3)
+    for hand in range(64)
+]
+
+# MOVE_TABLES[side][row][chunk << 3 | available] is the mask of legal moves in
+# `row` for `side`, given that row's 9-bit chunk of the board code and the
+# available sizes. An empty cell takes any size in hand, an opponent's piece
+# any strictly larger one, and the side's own pieces none.
+def build_move_tables():
+    tables = [[[0] * 4096 for row in range(3)] for side in range(2)]
+    for side in range(2):
+        for row in range(3):
+            for chunk in range(512):
+                for available in range(8):
+                    mask = 0
+                    for col in range(3):
+                        code = (chunk >> (3 * (2 - col))) & 7
+                        if code == 0:
+                            smallest = 0
+                        elif code >> 2 != side:
+                            smallest = code & 3
+                        else:
+                            continue
+                        for size in range(smallest, 3):
+                            if available & (1 << size):
+                                mask |= 1 << ((row * 3 + col) * 3 + size)
+                    tables[side][row][(chunk << 3) | available] = mask
+    return tables
+
+MOVE_TABLES = build_move_tables()
+
+
+def iterate_moves(move_mask):
+    # The moves of a move mask, lowest first
+    while move_mask:
+        lowest = move_mask & -move_mask
+        yield lowest.bit_length() - 1
+        move_mask ^= lowest
+
+
+def completing_cells(mask):
+    # Cells that would finish a line for the player holding `mask`
+    cells = 0
+    for line in LINES:
+        missing = line & ~mask
+        if missing and missing & (missing - 1) == 0:
+            cells |= missing
+    return cells
+
+COMPLETING_CELLS = [completing_cells(mask) for mask in range(512)]
+
+
+# Status of every (X cells, O cells) pair, indexed x << 9 | o: the winner
+# check_connect_3 reports, X's lead in pieces on the board, and how many more
+# lines X than O has entered alone. Only disjoint pairs are filled in. Built
+# by the first game rather than on import, so modules that only need the
+# encoders and the vectorized helpers do not pay for them.
+@functools.cache
+def position_tables():
+    winners = [None] * (1 << 18)
+    balances = [0] * (1 << 18)
+    open_lines = [0] * (1 << 18)
+    for x in range(512):
+        free = FULL_BOARD ^ x
+        o = free
+        while True:
+            index = (x << 9) | o
+            for line in reversed(LINES):
+                if o & line == line:
+                    winners[index] = "O"
+                if x & line == line:
+                    winners[index] = "X"
+                if x & line and not o & line:
+                    open_lines[index] += 1
+                elif o & line and not x & line:
+                    open_lines[index] -= 1
+            balances[index] = x.bit_count() - o.bit_count()
+            if o == 0:
+                break
+            o = (o - 1) & free
+    return winners, balances, open_lines
+
+
+class SearchTimeout(Exception):
+    # Raised inside a budgeted search when its deadline passes
+    pass
+
+
+def one_ply_back(value):
+    # A child's value as seen from its parent: a decided game is one ply further off
+    if value > DECIDED:
+        return value - 1
+    if value < -DECIDED:
+        return value + 1
+    return value
+
+
+def one_ply_forward(value):
+    # Inverse of one_ply_back, to hand a parent's alpha-beta window to a child
+    if value > DECIDED:
+        return value + 1
+    if value < -DECIDED:
+        return value - 1
+    return value
+
+
+def pack_counts(counts):
+    packed = 0
+    for player, shifts in zip(PLAYERS, COUNT_SHIFTS):
+        for size, shift in zip(SIZES, shifts):
+            packed |= counts[player][size] << shift
+    return packed
+
+
+def pieces_left(packed):
+    # Pieces both players still hold
+    return sum((packed >> shift) & 3 for shift in range(0, 12, 2))
+
+
+def unpack_counts(packed):
+    return {
+        player: {size: (packed >> shift) & 3 for size, shift in zip(SIZES, shifts)}
+        for player, shifts in zip(PLAYERS, COUNT_SHIFTS)
+    }
+
 
 class TicTacToe:
-    def __init__(self):
-        self.board = [[" " for _ in range(3)] for _ in range(3)]
-        self.counts = {
-            "X": {"s": 3, "m": 3, "l": 2},
-            "O": {"s": 3, "m": 3, "l": 2}
-        }
-        self.current_player = "X"  # default with player X
-        
-        self.memo_file_path = "full_search_updated.pkl"  # Use .pkl for pickle
-        self.memo = self.load_memoization()  # Load memoization on initialization
+    def __init__(self, initial_counts=INITIAL_COUNTS, memo_file_path="full_search_updated.tb", stats=None,
+                 memo_entries=None, replacement="depth"):
+        # Rule variants with a different piece inventory need their own memo file
+        self.initial_counts = initial_counts
+        self.line_winners, self.piece_balance, self.open_lines = position_tables()
+        self.reset()
+
+        if memo_file_path and memo_entries:
+            raise ValueError("memo_entries sizes a live search table, which needs memo_file_path=None")
+        self.memo_file_path = memo_file_path  # .tb compact table, .rtb ranked table, .ctb compressed table, .pkl pickle, None to start empty
+        # With memo_file_path=None, a fixed-size TranspositionTable of this many
+        # entries instead of a dict that grows without bound
+        self.memo_entries = memo_entries
+        self.replacement = replacement  # TranspositionTable replacement policy, "depth" or "always"
+        self.memo = self.load_memoization()  # Shared with every game using the same file, read on first lookup
+        # Alpha-beta results that are only bounds: key -> (flag, value)
+        self.bounds = self.memo.bound_entries if memo_entries else {}
+        self.stats = stats  # SearchStats to fill in, None to skip the bookkeeping
+        self.horizon_reached = False  # Whether the last timed_best_move round cut off any line at its horizon
 
 
     def load_memoization(self):
-        if os.path.exists(self.memo_file_path):
-            with open(self.memo_file_path, "rb") as file:
-                return pickle.load(file)
+        if self.memo_file_path:
+            return shared_table(self.memo_file_path)
+        if self.memo_entries:
+            return TranspositionTable(self.memo_entries, self.replacement)
         return {}
 
     def save_memoization(self):
-        with open(self.memo_file_path, "wb") as file:
-            pickle.dump(self.memo, file)
+        # A game with memo_file_path=None keeps its memo in memory only
+        if self.memo_file_path:
+            save_memo(self.memo_file_path, self.memo, self.initial_counts)
+
+    # The list-of-strings board and nested counts dict are views built from
+    # the bitboards, kept for the GUI, the tests and the string encoders
+    @property
+    def board(self):
+        return [[PIECE_STRINGS[self.cell_code(row * 3 + col)] for col in range(3)] for row in range(3)]
+
+    @board.setter
+    def board(self, board):
+        self.owners = [0, 0]
+        self.sizes = [0, 0, 0]
+        for row in range(3):
+            for col in range(3):
+                code = PIECE_CODES[board[row][col]]
+                if code:
+                    bit = 1 << (row * 3 + col)
+                    self.owners[code >> 2] |= bit
+                    self.sizes[(code & 3) - 1] |= bit
+        self.compute_symmetry_hashes()
+
+    def load_position(self, board_code, packed_counts):
+        # Set up a position from a 27-bit board code and packed counts, with
+        # the side to move given by how many pieces have been played
+        self.owners = [0, 0]
+        self.sizes = [0, 0, 0]
+        for cell in range(9):
+            code = (board_code >> CELL_SHIFTS[cell]) & 7
+            if code:
+                self.owners[code >> 2] |= 1 << cell
+                self.sizes[(code & 3) - 1] |= 1 << cell
+        self.packed_counts = packed_counts
+        self.turn = (pieces_left(pack_counts(self.initial_counts)) - pieces_left(packed_counts)) & 1
+        self.compute_symmetry_hashes()
+
+    @property
+    def counts(self):
+        return unpack_counts(self.packed_counts)
+
+    @counts.setter
+    def counts(self, counts):
+        self.packed_counts = pack_counts(counts)
+
+    @property
+    def current_player(self):
+        return PLAYERS[self.turn]
+
+    @current_player.setter
+    def current_player(self, player):
+        self.turn = PLAYERS.index(player)
+
+    def cell_code(self, cell):
+        # The identity transformation is the encoded board itself
+        return (self.symmetry_hashes[0] >> CELL_SHIFTS[cell]) & 7
+
+    def compute_symmetry_hashes(self):
+        # Rebuild the 27-bit board code under each transformation from scratch;
+        # make_move and revert_move keep them up to date incrementally after this
+        self.symmetry_hashes = [0] * len(TRANSFORMATIONS)
+        for cell in range(9):
+            bit = 1 << cell
+            if self.owners[0] & bit:
+                code = 0
+            elif self.owners[1] & bit:
+                code = 4
+            else:
+                continue
+            code |= 1 if self.sizes[0] & bit else 2 if self.sizes[1] & bit else 3
+            self.symmetry_hashes = list(map(add, self.symmetry_hashes, SYMMETRY_DELTAS[cell][0][code]))
 
     def print_board(self):
         for row in self.board:
@@ -31,105 +363,98 @@ class TicTacToe:
             print("-" * 9)
 
     def check_connect_3(self):
-        def all_same_and_valid(items):
-            return all(item != " " and item[1] == items[0][1] for item in items)
-
-        # Check rows
-        for row in self.board:
-            if all_same_and_valid(row):
-                return row[0][1]
-
-        # Check columns
-        for col in range(3):
-            if all_same_and_valid([self.board[0][col], self.board[1][col], self.board[2][col]]):
-                return self.board[0][col][1]
-
-        # Check diagonals
-        if all_same_and_valid([self.board[0][0], self.board[1][1], self.board[2][2]]):
-            return self.board[0][0][1]
-        if all_same_and_valid([self.board[0][2], self.board[1][1], self.board[2][0]]):
-            return self.board[0][2][1]
-
-        return None
+        return self.line_winners[(self.owners[0] << 9) | self.owners[1]]
 
     def is_full(self):
-        return all(cell != " " for row in self.board for cell in row)
+        return self.owners[0] | self.owners[1] == FULL_BOARD
 
     def can_replace(self, old_piece, new_size):
         # Extract the size of the old piece
         old_size = old_piece[0]
 
-        # Define the size hierarchy
-        size_order = {'s': 1, 'm': 2, 'l': 3}
-
         # Check if the new size is larger than the old size, 
         # if the new size is available, and if the piece belongs to the opponent
-        return (size_order[new_size] > size_order[old_size] and
-                self.counts[self.current_player][new_size] > 0 and
+        return (SIZE_INDEX[new_size] > SIZE_INDEX[old_size] and
+                (self.packed_counts >> COUNT_SHIFTS[self.turn][SIZE_INDEX[new_size]]) & 3 > 0 and
                 old_piece[1] != self.current_player)  # Ensure it's the opponent's piece
 
+    # make_move returns the replaced cell code (0 when the cell was empty),
+    # which revert_move takes back to restore the cell
     def make_move(self, row, col, size):
-        original_piece = self.board[row][col]
-        self.board[row][col] = f"{size}{self.current_player}"
-        self.counts[self.current_player][size] -= 1
-        self.switch_player()
-        return original_piece
+        return self.play_move((row * 3 + col) * 3 + SIZE_INDEX[size])
 
     def revert_move(self, row, col, size, original_piece):
-        self.switch_player()
-        self.board[row][col] = original_piece
-        self.counts[self.current_player][size] += 1
+        self.undo_move((row * 3 + col) * 3 + SIZE_INDEX[size], original_piece)
+
+    # play_move and undo_move do the same for a move int
+    def play_move(self, move):
+        cell, size_index = divmod(move, 3)
+        bit = 1 << cell
+        original_piece = (self.symmetry_hashes[0] >> CELL_SHIFTS[cell]) & 7
+        if original_piece:
+            self.owners[original_piece >> 2] ^= bit
+            self.sizes[(original_piece & 3) - 1] ^= bit
+        self.owners[self.turn] |= bit
+        self.sizes[size_index] |= bit
+        new_piece = (self.turn << 2) | (size_index + 1)
+        self.symmetry_hashes = list(map(add, self.symmetry_hashes, SYMMETRY_DELTAS[cell][original_piece][new_piece]))
+        self.packed_counts -= 1 << COUNT_SHIFTS[self.turn][size_index]
+        self.turn ^= 1
+        return original_piece
 
+    def undo_move(self, move, original_piece):
+        self.turn ^= 1
+        cell, size_index = divmod(move, 3)
+        bit = 1 << cell
+        self.owners[self.turn] ^= bit
+        self.sizes[size_index] ^= bit
+        if original_piece:
+            self.owners[original_piece >> 2] |= bit
+            self.sizes[(original_piece & 3) - 1] |= bit
+        new_piece = (self.turn << 2) | (size_index + 1)
+        self.symmetry_hashes = list(map(add, self.symmetry_hashes, SYMMETRY_DELTAS[cell][new_piece][original_piece]))
+        self.packed_counts += 1 << COUNT_SHIFTS[self.turn][size_index]
+
+
+    def valid_move_mask(self):
+        # Legal moves as a 27-bit mask, bit `move` set for each: three table
+        # lookups, one per board row
+        available = AVAILABLE_SIZES[(self.packed_counts >> HAND_SHIFTS[self.turn]) & 63]
+        board = self.symmetry_hashes[0]
+        tables = MOVE_TABLES[self.turn]
+        return (tables[0][((board >> 18) << 3) | available]
+                | tables[1][(((board >> 9) & 511) << 3) | available]
+                | tables[2][((board & 511) << 3) | available])
 
     def get_valid_moves(self):
-        valid_moves = []
-        for i in range(3):
-            for j in range(3):
-                current_piece = self.board[i][j]
-                # If the cell is empty, check for all piece sizes
-                if current_piece == " ":
-                    for size in self.counts[self.current_player]:
-                        if self.counts[self.current_player][size] > 0:
-                            valid_moves.append((i, j, size))  # Add (row, col, size) as a valid move
-                else:
-                    # If there's a piece already, check if it can be replaced
-                    if current_piece[1] != self.current_player:
-                        for size in self.counts[self.current_player]:
-                            if self.counts[self.current_player][size] > 0 and self.can_replace(current_piece, size):
-                                valid_moves.append((i, j, size))  # Add (row, col, size) as a valid replacement move
-
-        return valid_moves
+        return [MOVE_TUPLES[move] for move in iterate_moves(self.valid_move_mask())]
+
+    def has_pieces_in_hand(self):
+        # Whether the side to move still holds a piece. On a board that is not
+        # full this is the same as having a valid move: any piece fits an empty cell
+        return AVAILABLE_SIZES[(self.packed_counts >> HAND_SHIFTS[self.turn]) & 63] != 0
 
     def check_game_over(self):
-        winner = self.check_connect_3()
+        x, o = self.owners
+        winner = self.line_winners[(x << 9) | o]
 
         if winner:
             return winner
-        if self.is_full() or not self.get_valid_moves():
-            (x, o) = self.count_pieces_on_board()
-            if x > o:
-                return "X"
-            elif o > x:
-                return "O"
-            else:
-                return "IMPOSSIBLE"
+        if x | o == FULL_BOARD or not self.has_pieces_in_hand():
+            # This used to unpack count_pieces_on_board, which yields its keys,
+            # and "X" > "O", so a settled game has always gone to X. The table
+            # and the builder are built on that rule, so it stays.
+            return "X"
         return None
 
     def count_pieces_on_board(self):
-        piece_count = {
-            "X": 0,
-            "O": 0
+        return {
+            "X": self.owners[0].bit_count(),
+            "O": self.owners[1].bit_count()
         }
-        
-        for row in self.board:
-            for cell in row:
-                if cell != " ":  # If the cell is not empty
-                    piece_count[cell[1]] += 1  # Increment the count for the player
-
-        return piece_count
 
     def switch_player(self):
-        self.current_player = "O" if self.current_player == "X" else "X"
+        self.turn ^= 1
 
     def board_key(self):
         # Convert the board into a string representation
@@ -140,20 +465,11 @@ class TicTacToe:
         return f"{board_str}|{counts_str}"
 
     def encoded_game_state(self):
-        # Obtain the board_key string
-        board_str_key = self.board_key()
-
-        # Convert the board portion
-        board_part, counts_part = board_str_key.split("|")
-
-        board_binary = self.encoded_board(board_part)
-        normalized_board_binary = self.canonical_form(board_binary)
-        counts_binary = self.encoded_counts(counts_part)
-
-        # Combine board and counts into one binary string
-        full_binary_key = normalized_board_binary + counts_binary
-        # return full_binary_key
-        return int(full_binary_key, 2)
+        # The side to move, then the same integer as encoding board_key() with
+        # encoded_board, canonical_form and encoded_counts: the smallest
+        # transformed board code is the canonical board, followed by the
+        # 12-bit counts word
+        return (self.turn << SIDE_SHIFT) | (min(self.symmetry_hashes) << 12) | self.packed_counts
 
     def encoded_board(self, board):
         # Map pieces from the board key string to binary
@@ -193,48 +509,13 @@ class TicTacToe:
     
     # Find same boards that are just flipped/mirrored to minimize redundant search
     def canonical_form(self, board_binary):
-        # Define transformations with index mappings
-        transformations = [
-            [0, 1, 2,   # Original
-            3, 4, 5,
-            6, 7, 8],
-            
-            [6, 3, 0,   # 90° Rotation
-            7, 4, 1,
-            8, 5, 2],
-            
-            [8, 7, 6,   # 180° Rotation
-            5, 4, 3,
-            2, 1, 0],
-            
-            [2, 5, 8,   # 270° Rotation
-            1, 4, 7,
-            0, 3, 6],
-            
-            [2, 1, 0,   # Horizontal Flip
-            5, 4, 3,
-            8, 7, 6],
-            
-            [6, 7, 8,   # Vertical Flip
-            3, 4, 5,
-            0, 1, 2],
-            
-            [0, 3, 6,   # Diagonal (\) Flip
-            1, 4, 7,
-            2, 5, 8],
-            
-            [8, 5, 2,   # Diagonal (/) Flip
-            7, 4, 1,
-            6, 3, 0]
-        ]
-
         # Convert `board_binary` into chunks of 3 bits per cell
         board_cells = [board_binary[i:i+3] for i in range(0, len(board_binary), 3)]
         
         # Apply each transformation and store the resulting strings
         transformed_boards = []
 
-        for transformation in transformations:
+        for transformation in TRANSFORMATIONS:
             transformed_board = ''.join(board_cells[i] for i in transformation)
             transformed_boards.append(transformed_board)
 
@@ -245,43 +526,267 @@ class TicTacToe:
         return smallest_board
 
 
-    def minimax(self, depth, is_maximizing):
-        board_state = self.encoded_game_state()
-        if board_state in self.memo:
-            return self.memo[board_state]
-
+    def terminal_value(self):
+        # Score of a finished game, None while the game goes on. Parents take
+        # one_ply_back of it, which favors wins that occur sooner and losses
+        # that occur later.
         winner = self.check_game_over()
         if winner == "X":
-            # self.save_memoization()
-            return 10 - depth  # Favor wins that occur sooner
+            return WIN
         elif winner == "O":
-            # self.save_memoization()
-            return depth - 10  # Favor losses that occur later
+            return -WIN
         elif winner == "IMPOSSIBLE":  # Draw case
-            # self.save_memoization()
             return 0
+        return None
+
+    def minimax(self, depth, is_maximizing):
+        stats = self.stats
+        if stats is None:
+            board_state = self.encoded_game_state()
+        else:
+            stats.visit(depth)
+            board_state = stats.canonicalize(self.encoded_game_state)
+        memo_value = self.memo.get(board_state)
+        if memo_value is not None:
+            if stats is not None:
+                stats.memo_hits += 1
+            return memo_value
+
+        value = self.terminal_value()
+        if stats is not None:
+            stats.memo_misses += 1
+            stats.terminal_hits += value is not None
+        if value is not None:
+            return value
 
         if is_maximizing:
             max_eval = float('-inf')
-            for (row, col, size) in self.get_valid_moves():
-                original_piece = self.make_move(row, col, size)
-                eval = self.minimax(depth + 1, False)
-                self.revert_move(row, col, size, original_piece)
+            for move in iterate_moves(self.valid_move_mask()):
+                original_piece = self.play_move(move)
+                eval = one_ply_back(self.minimax(depth + 1, False))
+                self.undo_move(move, original_piece)
                 max_eval = max(max_eval, eval)
             self.memo[board_state] = max_eval
+            if stats is not None:
+                stats.memo_size(len(self.memo))
             return max_eval
         else:
             min_eval = float('inf')
-            for (row, col, size) in self.get_valid_moves():
-                original_piece = self.make_move(row, col, size)
-                eval = self.minimax(depth + 1, True)
-                self.revert_move(row, col, size, original_piece)
+            for move in iterate_moves(self.valid_move_mask()):
+                original_piece = self.play_move(move)
+                eval = one_ply_back(self.minimax(depth + 1, True))
+                self.undo_move(move, original_piece)
                 min_eval = min(min_eval, eval)
             self.memo[board_state] = min_eval
+            if stats is not None:
+                stats.memo_size(len(self.memo))
             return min_eval
 
+    def ordered_moves(self):
+        # get_valid_moves with likely cutoffs first: moves that complete a
+        # line, then moves onto a cell the opponent needs for a line, then
+        # replacements of opponent pieces. Ties keep get_valid_moves order.
+        own = self.owners[self.turn]
+        opponent = self.owners[self.turn ^ 1]
+        winning = COMPLETING_CELLS[own]
+        blocking = COMPLETING_CELLS[opponent] & ~opponent
+
+        def priority(move):
+            bit = 1 << (move // 3)
+            if winning & bit:
+                return 0
+            if blocking & bit:
+                return 1
+            if opponent & bit:
+                return 2
+            return 3
+
+        return sorted(iterate_moves(self.valid_move_mask()), key=priority)
+
+    def alphabeta(self, depth, alpha, beta, is_maximizing):
+        # minimax with alpha-beta cutoffs. Exact values go to self.memo like
+        # minimax's; a search cut off by the window only yields a bound, which
+        # goes to self.bounds with its flag. A cutoff from a bound counts as a memo hit.
+        stats = self.stats
+        if stats is None:
+            board_state = self.encoded_game_state()
+        else:
+            stats.visit(depth)
+            board_state = stats.canonicalize(self.encoded_game_state)
+        memo_value = self.memo.get(board_state)
+        if memo_value is not None:
+            if stats is not None:
+                stats.memo_hits += 1
+            return memo_value
+        bound = self.bounds.get(board_state)
+        if bound is not None:
+            flag, value = bound
+            if (flag == LOWER_BOUND and value >= beta) or (flag == UPPER_BOUND and value <= alpha):
+                if stats is not None:
+                    stats.memo_hits += 1
+                return value
+
+        value = self.terminal_value()
+        if stats is not None:
+            stats.memo_misses += 1
+            stats.terminal_hits += value is not None
+        if value is not None:
+            return value
+
+        window_alpha, window_beta = alpha, beta
+        if is_maximizing:
+            best_eval = float('-inf')
+            for move in self.ordered_moves():
+                original_piece = self.play_move(move)
+                eval = one_ply_back(self.alphabeta(depth + 1, one_ply_forward(alpha), one_ply_forward(beta), False))
+                self.undo_move(move, original_piece)
+                best_eval = max(best_eval, eval)
+                alpha = max(alpha, best_eval)
+                if alpha >= beta:
+                    break
+        else:
+            best_eval = float('inf')
+            for move in self.ordered_moves():
+                original_piece = self.play_move(move)
+                eval = one_ply_back(self.alphabeta(depth + 1, one_ply_forward(alpha), one_ply_forward(beta), True))
+                self.undo_move(move, original_piece)
+                best_eval = min(best_eval, eval)
+                beta = min(beta, best_eval)
+                if alpha >= beta:
+                    break
+
+        if best_eval <= window_alpha:
+            self.bounds[board_state] = (UPPER_BOUND, best_eval)
+        elif best_eval >= window_beta:
+            self.bounds[board_state] = (LOWER_BOUND, best_eval)
+        else:
+            self.memo[board_state] = best_eval
+            self.bounds.pop(board_state, None)
+            if stats is not None:
+                stats.memo_size(len(self.memo))
+        return best_eval
+
+
+    def heuristic_value(self):
+        # Estimate for a position at the search horizon, from X's side: piece
+        # balance, then lines one side has entered and the other has not.
+        # Kept inside (-1, 1) so it stays below the score of an early win.
+        index = (self.owners[0] << 9) | self.owners[1]
+        return (self.piece_balance[index] + self.open_lines[index] / 10) / 10
+
+    def limited_search(self, depth, plies, alpha, beta, is_maximizing, deadline):
+        # alphabeta that stops `plies` moves below the root's children and
+        # scores those positions with heuristic_value. Nothing is stored,
+        # since the values depend on the horizon; exact memo values are used.
+        if time.monotonic() >= deadline:
+            raise SearchTimeout
+        memo_value = self.memo.get(self.encoded_game_state())
+        if memo_value is not None:
+            return memo_value
+
+        value = self.terminal_value()
+        if value is not None:
+            return value
+        if plies == 0:
+            self.horizon_reached = True
+            return self.heuristic_value()
+
+        best_eval = float('-inf') if is_maximizing else float('inf')
+        for move in self.ordered_moves():
+            original_piece = self.play_move(move)
+            eval = one_ply_back(self.limited_search(depth + 1, plies - 1, one_ply_forward(alpha),
+                                                    one_ply_forward(beta), not is_maximizing, deadline))
+            self.undo_move(move, original_piece)
+            if is_maximizing:
+                best_eval = max(best_eval, eval)
+                alpha = max(alpha, best_eval)
+            else:
+                best_eval = min(best_eval, eval)
+                beta = min(beta, best_eval)
+            if alpha >= beta:
+                break
+        return best_eval
+
+    def timed_best_move(self, time_budget_ms, isTimed = False):
+        # Iterative deepening: search one ply deeper each round, starting with
+        # the previous round's move, and return the last move found when the
+        # budget runs out. A round that never reached its horizon searched to
+        # the end of the game (or hit the table everywhere), so its move is exact.
+        deadline = time.monotonic() + time_budget_ms / 1000
+        is_maximizing = self.current_player == "X"
+        moves = self.ordered_moves()
+        if not moves:
+            return None
+        move = moves[0]
+        state = (list(self.owners), list(self.sizes), list(self.symmetry_hashes), self.packed_counts, self.turn)
+        for plies in range(pieces_left(self.packed_counts)):
+            self.horizon_reached = False
+            best_val = float('-inf') if is_maximizing else float('inf')
+            round_move = None
+            try:
+                for candidate in moves:
+                    original_piece = self.play_move(candidate)
+                    if is_maximizing:
+                        move_val = self.limited_search(0, plies, one_ply_forward(best_val), float('inf'), False, deadline)
+                    else:
+                        move_val = self.limited_search(0, plies, float('-inf'), one_ply_forward(best_val), True, deadline)
+                    move_val = one_ply_back(move_val)
+                    self.undo_move(candidate, original_piece)
+                    if (is_maximizing and move_val > best_val) or (not is_maximizing and move_val < best_val):
+                        best_val = move_val
+                        round_move = candidate
+            except SearchTimeout:
+                # Undo the moves still applied below the root
+                self.owners, self.sizes, self.symmetry_hashes, self.packed_counts, self.turn = state
+                # The previous move was searched first, so a move found in
+                # the unfinished round has beaten it at the deeper horizon
+                if round_move is not None:
+                    move = round_move
+                break
+
+            move = round_move
+            moves.remove(move)
+            moves.insert(0, move)
+            if isTimed:
+                print("Depth", plies + 1, "best", MOVE_TUPLES[move], "value", best_val)
+            if not self.horizon_reached:
+                break
+        return MOVE_TUPLES[move]
+
+    def stored_move(self):
+        # Best move the table holds for this position, or None. It is stored
+        # for the canonical board, so map its cell back through the symmetry
+        # encoded_game_state picked: canonical cell k is cell TRANSFORMATIONS[t][k]
+        if isinstance(self.memo, dict):
+            return None
+        canonical = min(self.symmetry_hashes)
+        code = self.memo.stored_move((self.turn << SIDE_SHIFT) | (canonical << 12) | self.packed_counts)
+        if code is None:
+            return None
+        transformation = TRANSFORMATIONS[self.symmetry_hashes.index(canonical)]
+        row, col = CELL_ROW_COL[transformation[code // 3]]
+        return (row, col, SIZES[code % 3])
+
+    def player_move(self, time_budget_ms = PLAYER_TIME_BUDGET_MS):
+        # The move the CLI and GUI play: the exact best move from a loaded
+        # table, or a time-budgeted search without one. A budgeted search
+        # only reads the memo, so an empty table stays empty.
+        if self.memo_file_path and len(self.memo):
+            return self.best_move()
+        return self.best_move(time_budget_ms=time_budget_ms)
+
+    def best_move(self, isTimed = False, search = "minimax", time_budget_ms = None):
+        # A move stored in the table answers with a single lookup. Otherwise,
+        # search="alphabeta" picks the same move as minimax: each child is
+        # searched with the best value so far as its bound, so only children
+        # that could become the new best get an exact value.
+        # time_budget_ms bounds the response time instead, see timed_best_move
+        move = self.stored_move()
+        if move is not None:
+            return move
+        if time_budget_ms is not None:
+            return self.timed_best_move(time_budget_ms, isTimed)
 
-    def best_move(self, isTimed = False):
         # Initialize best value for max/min depending on player symbol
         best_val = float('-inf') if self.current_player == "X" else float('inf')
         move = None
@@ -291,11 +796,21 @@ class TicTacToe:
                 print("Starting", row, col, size, "move at")
                 get_current_date_time()
                 start_time = time.time()
-            
+            if self.stats is not None:
+                move_start = time.perf_counter()
+
             original_piece = self.make_move(row, col, size)
-            move_val = self.minimax(0, not is_maximizing)
+            if search == "alphabeta" and is_maximizing:
+                move_val = self.alphabeta(0, one_ply_forward(best_val), float('inf'), False)
+            elif search == "alphabeta":
+                move_val = self.alphabeta(0, float('-inf'), one_ply_forward(best_val), True)
+            else:
+                move_val = self.minimax(0, not is_maximizing)
+            move_val = one_ply_back(move_val)
             self.revert_move(row, col, size, original_piece)
 
+            if self.stats is not None:
+                self.stats.add_phase(f"best_move {row} {col} {size}", time.perf_counter() - move_start)
             if isTimed:
                 elapsed_time = time.time() - start_time
                 print("Duration:", format_time(elapsed_time))
@@ -309,22 +824,135 @@ class TicTacToe:
                 move = (row, col, size)
         return move
 
+    # Perft: count the move sequences from the current position, through the
+    # public move API only, to check a move generator or time it. Counts are
+    # {"nodes": positions exactly `depth` plies on, "X"/"O"/"IMPOSSIBLE": games
+    # that finished within `depth` plies, by result}. A finished game is not
+    # played on; one that finishes on the last ply is also a node.
+    def perft(self, depth):
+        counts = {"nodes": 0, "X": 0, "O": 0, "IMPOSSIBLE": 0}
+        if depth == 0:
+            counts["nodes"] = 1
+        elif self.check_game_over() is None:
+            for move in self.get_valid_moves():
+                self.perft_count(move, depth, counts)
+        return counts
+
+    def perft_divide(self, depth):
+        # perft split by first move, as {move: counts}
+        divided = {}
+        if depth > 0 and self.check_game_over() is None:
+            for move in self.get_valid_moves():
+                divided[move] = {"nodes": 0, "X": 0, "O": 0, "IMPOSSIBLE": 0}
+                self.perft_count(move, depth, divided[move])
+        return divided
+
+    def perft_count(self, move, depth, counts):
+        # Add the sequences starting with `move` to counts, `move` being ply 1 of `depth`
+        original_piece = self.make_move(*move)
+        winner = self.check_game_over()
+        if winner is not None:
+            counts[winner] += 1
+        if winner is not None or depth == 1:
+            counts["nodes"] += depth == 1
+        else:
+            for reply in self.get_valid_moves():
+                self.perft_count(reply, depth - 1, counts)
+        self.revert_move(*move, original_piece)
+
+    def perft_unique(self, depth):
+        # perft after symmetry reduction: the same counts, but over distinct
+        # canonical positions (encoded_game_state) instead of move sequences
+        root = (self.symmetry_hashes[0], self.packed_counts, self.turn)
+        counts = {"nodes": 0, "X": 0, "O": 0, "IMPOSSIBLE": 0}
+        frontier = [root]
+        if depth > 0 and self.check_game_over() is not None:
+            frontier = []
+        for ply in range(1, depth + 1):
+            children = {}
+            for position in frontier:
+                self.set_position(*position)
+                for move in self.get_valid_moves():
+                    original_piece = self.make_move(*move)
+                    key = self.encoded_game_state()
+                    if key not in children:
+                        winner = self.check_game_over()
+                        if winner is not None:
+                            counts[winner] += 1
+                        # Finished games are not played on
+                        children[key] = None if winner else (self.symmetry_hashes[0], self.packed_counts, self.turn)
+                    self.revert_move(*move, original_piece)
+            counts["nodes"] = len(children)
+            frontier = [position for position in children.values() if position is not None]
+        if depth == 0:
+            counts["nodes"] = 1
+        self.set_position(*root)
+        return counts
+
+    def set_position(self, board_code, packed_counts, turn):
+        # load_position with an explicit side to move
+        self.load_position(board_code, packed_counts)
+        self.turn = turn
+
     def reset(self):
-        self.board = [[" " for _ in range(3)] for _ in range(3)]
-        self.counts = {
-            "X": {"s": 3, "m": 3, "l": 2},
-            "O": {"s": 3, "m": 3, "l": 2}
-        }
-        self.current_player = "X"  # default with player X
-        
-    def populate_memoization_table(self, isTimed = False):
+        self.owners = [0, 0]  # Cells held by X, O
+        self.sizes = [0, 0, 0]  # Cells holding a small, medium, large piece
+        self.symmetry_hashes = [0] * len(TRANSFORMATIONS)  # Encoded board under each transformation
+        self.packed_counts = pack_counts(self.initial_counts)
+        self.turn = 0  # default with player X
         
+    def populate_memoization_table(self, isTimed = False, jobs = 1, checkpoint_dir = None,
+                                   checkpoint_entries = CHECKPOINT_ENTRIES, checkpoint_seconds = CHECKPOINT_SECONDS,
+                                   spill_dir = None, max_memory = None):
+        # checkpoint_dir keeps the new entries there as append-only segments,
+        # see ReplaceTTTCheckpoint.py, and a rerun with the same directory
+        # resumes from them; compact_checkpoints merges them into a table.
+        # max_memory (bytes) keeps the memo under that budget by spilling
+        # sorted runs to spill_dir, or a temporary directory when it is None,
+        # see ReplaceTTTExternal.py; memo.save merges them into a table.
         if isTimed:
             print("Starting populating at")
             get_current_date_time()
             start_time = time.time()
+        if self.stats is not None:
+            populate_start = time.perf_counter()
+        if jobs > 1:
+            # Checked here rather than after the parallel build has run
+            if not isinstance(self.memo, dict):
+                raise ValueError("a parallel populate needs a game with memo_file_path=None")
+            if self.owners != [0, 0] or self.packed_counts != pack_counts(self.initial_counts):
+                raise ValueError("a parallel populate starts from the empty board")
+        if max_memory:
+            if not isinstance(self.memo, dict) or jobs > 1 or checkpoint_dir:
+                raise ValueError("a memory budget needs memo_file_path=None, one job and no checkpoints")
+            memo = self.memo
+            self.memo = SpillingMemo(spill_dir, max_memory)
+            self.memo.update(memo)
+        if checkpoint_dir:
+            if not isinstance(self.memo, dict):
+                raise ValueError("checkpointing needs a game with memo_file_path=None")
+            if jobs > 1:
+                # The parallel path solves every layer before the memo sees
+                # any of it, so there would be nothing to checkpoint until the end
+                raise ValueError("checkpointing needs one job")
+            memo = self.memo
+            self.memo = CheckpointedMemo(checkpoint_dir, checkpoint_entries, checkpoint_seconds)
+            self.memo.update(memo)
+            if isTimed:
+                print("Resumed", self.memo.resumed, "entries from", checkpoint_dir)
+        if jobs > 1:
+            # Solve every position layer by layer across worker processes,
+            # see RetrogradeBuilder, so the search below only finds memo hits
+            self.populate_in_layers(jobs)
         # Start the memoization process by calling minimax on the empty board
         self.best_move(isTimed)
+        if checkpoint_dir:
+            self.memo.checkpoint()
+        # Sort so the table comes out the same whatever the number of jobs
+        if isinstance(self.memo, dict):
+            self.memo = dict(sorted(self.memo.items()))
+        if self.stats is not None:
+            self.stats.add_phase("populate", time.perf_counter() - populate_start)
 
         if isTimed:
             elapsed_time = time.time() - start_time
@@ -334,6 +962,30 @@ class TicTacToe:
         # Duration: 230m 21s when using shelve and print statements for depth < 7
         # Duration: 27m 1s when using int index with pickle no prints
 
+    def populate_in_layers(self, jobs):
+        # The builder imports this module, so it is imported here
+        from ReplaceTTTBuild import RetrogradeBuilder
+        builder = RetrogradeBuilder(initial_counts=self.initial_counts, stats=self.stats, jobs=jobs)
+        builder.build()
+        self.memo.update(builder.memo())
+
+def canonical_forms(board_codes):
+    # Vectorized canonical_form over an array of 27-bit board codes. Returns
+    # the canonical codes and the index into TRANSFORMATIONS that produced each
+    board_codes = np.asarray(board_codes, dtype=np.int64)
+    chunks = [(board_codes >> shift) & 511 for shift in (18, 9, 0)]
+
+    transformed = np.empty((len(TRANSFORMATIONS),) + board_codes.shape, dtype=np.int64)
+    for t in range(len(TRANSFORMATIONS)):
+        tables = CHUNK_TABLES[t]
+        transformed[t] = tables[0][chunks[0]] | tables[1][chunks[1]] | tables[2][chunks[2]]
+
+    # argmin keeps the first transformation on ties, like min() over the strings
+    transform_index = transformed.argmin(axis=0)
+    canonical = np.take_along_axis(transformed, transform_index[np.newaxis], axis=0)[0]
+    return canonical, transform_index
+
+
 def get_current_date_time():
     # Get the current time in seconds since the Unix epoch
     current_time = time.time()
@@ -376,7 +1028,7 @@ def main():
                 # print(game.get_valid_moves())
 
                 print("AI is making a move...")
-                row, col, size = game.best_move()
+                row, col, size = game.player_move()
                 game.make_move(row, col, size)
                 game.print_board()
             else:
@@ -393,7 +1045,7 @@ def main():
                 # print(game.get_valid_moves())
 
                 print("AI is making a move...")
-                row, col, size = game.best_move()
+                row, col, size = game.player_move()
                 game.make_move(row, col, size)
                 game.print_board()
         
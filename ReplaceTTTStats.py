@@ -0,0 +1,67 @@
+import json
+import time
+
+
+class SearchStats:
+    # Counters a search or table build fills in when it is given one. Games
+    # and builders without one (the default) only pay an `is None` check per
+    # node. Depths are minimax depths: best_move searches the root's children at 0.
+    def __init__(self):
+        self.nodes_per_depth = {}
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.terminal_hits = 0
+        self.canonicalization_seconds = 0.0
+        self.peak_memo_size = 0
+        self.phase_seconds = {}  # best_move root moves, builder layers -> wall time
+
+    def visit(self, depth):
+        self.nodes_per_depth[depth] = self.nodes_per_depth.get(depth, 0) + 1
+
+    def canonicalize(self, encode, *args):
+        # Call the encoder, timing it
+        start = time.perf_counter()
+        key = encode(*args)
+        self.canonicalization_seconds += time.perf_counter() - start
+        return key
+
+    def memo_size(self, size):
+        if size > self.peak_memo_size:
+            self.peak_memo_size = size
+
+    def add_phase(self, name, seconds):
+        self.phase_seconds[name] = self.phase_seconds.get(name, 0.0) + seconds
+
+    def merge(self, other):
+        # Add in the counters of another run, e.g. a worker process
+        for depth, nodes in other.nodes_per_depth.items():
+            self.nodes_per_depth[depth] = self.nodes_per_depth.get(depth, 0) + nodes
+        self.memo_hits += other.memo_hits
+        self.memo_misses += other.memo_misses
+        self.terminal_hits += other.terminal_hits
+        self.canonicalization_seconds += other.canonicalization_seconds
+        self.peak_memo_size = max(self.peak_memo_size, other.peak_memo_size)
+        for name, seconds in other.phase_seconds.items():
+            self.add_phase(name, seconds)
+
+    def to_dict(self):
+        lookups = self.memo_hits + self.memo_misses
+        return {
+            "nodes": sum(self.nodes_per_depth.values()),
+            "nodes_per_depth": {str(depth): nodes for depth, nodes in sorted(self.nodes_per_depth.items())},
+            "memo_hits": self.memo_hits,
+            "memo_misses": self.memo_misses,
+            "memo_hit_rate": self.memo_hits / lookups if lookups else 0.0,
+            "terminal_hits": self.terminal_hits,
+            "canonicalization_seconds": self.canonicalization_seconds,
+            "peak_memo_size": self.peak_memo_size,
+            "phase_seconds": dict(self.phase_seconds),
+        }
+
+    def to_json(self, path=None):
+        # The counters as a JSON string, also written to `path` when given
+        text = json.dumps(self.to_dict(), indent=2)
+        if path:
+            with open(path, "w") as file:
+                file.write(text + "\n")
+        return text
@@ -0,0 +1,396 @@
+import os
+import pickle
+import struct
+import sys
+import threading
+import warnings
+
+import numpy as np
+
+# Compact table file: a 16-byte header (magic, entry count) followed by the
+# sorted uint64 keys and then one int8 value per key. The file is memory-mapped
+# read-only, so opening it is instant and every process shares the same pages.
+TABLE_EXTENSION = ".tb"
+TABLE_MAGIC = b"RTTTTB03"
+# Same layout followed by one uint8 best move per key, cell * 3 + size in the
+# canonical board's coordinates, or NO_MOVE
+TABLE_MOVES_MAGIC = b"RTTTTB04"
+NO_MOVE = 255
+# Tables from before keys carried the side to move and values counted plies
+# to the end. Their values were relative to the search root (an X win ten
+# plies down scored 0 like a draw), so they cannot be converted, only rebuilt.
+LEGACY_TABLE_MAGICS = (b"RTTTTB01", b"RTTTTB02")
+LEGACY_VALUE_LIMIT = 10  # Legacy decided games scored at most 10, current ones over 80
+TABLE_HEADER = struct.Struct("<8sQ")
+# Key-free ranked tables, see ReplaceTTTRanking.py
+RANKED_EXTENSION = ".rtb"
+# Block-compressed tables, see ReplaceTTTCompressed.py
+COMPRESSED_EXTENSION = ".ctb"
+# Paths of tables placed in shared memory, see ReplaceTTTSharedMemory.py
+SHARED_MEMORY_PREFIX = "shm:"
+# Entries merge_tables reads from each input at a time
+MERGE_BLOCK = 1 << 20
+
+
+def write_table(path, keys, values, moves=None):
+    keys = np.asarray(keys, dtype="<u8")
+    values = np.asarray(values, dtype=np.int8)
+    magic = TABLE_MAGIC if moves is None else TABLE_MOVES_MAGIC
+    # Write then rename, so a table that is open elsewhere is never overwritten in place
+    with open(path + ".tmp", "wb") as file:
+        file.write(TABLE_HEADER.pack(magic, len(keys)))
+        file.write(keys.tobytes())
+        file.write(values.tobytes())
+        if moves is not None:
+            file.write(np.asarray(moves, dtype=np.uint8).tobytes())
+    os.replace(path + ".tmp", path)
+
+
+def memo_arrays(memo):
+    # Sorted key and value arrays for a memo dict or an open table backend
+    if not isinstance(memo, dict):
+        return memo.arrays()
+    keys = np.fromiter(memo.keys(), dtype=np.uint64, count=len(memo))
+    values = np.fromiter(memo.values(), dtype=np.int8, count=len(memo))
+    order = np.argsort(keys, kind="stable")
+    return keys[order], values[order]
+
+
+def table_columns(memo):
+    # Sorted keys, values and stored moves (None if it has none) of a memo
+    # dict or table backend
+    if getattr(memo, "has_moves", False):
+        return memo.arrays(with_moves=True)
+    return memo_arrays(memo) + (None,)
+
+
+def memo_lookup(memo, keys):
+    # Vectorized get on any memo: (found mask, values) like CompactTable.lookup
+    if not isinstance(memo, dict):
+        return memo.lookup(keys)
+    keys = np.asarray(keys, dtype=np.int64).tolist()
+    values = [memo.get(key) for key in keys]
+    found = np.array([value is not None for value in values], dtype=bool)
+    return found, np.array([value or 0 for value in values], dtype=np.int8)
+
+
+def is_legacy_memo(memo):
+    # A memo dict with root-relative values: current values are 0 for a draw
+    # and beyond LEGACY_VALUE_LIMIT for a decided game
+    return any(0 < abs(value) <= LEGACY_VALUE_LIMIT for value in memo.values())
+
+
+def load_pickle(path):
+    with open(path, "rb") as file:
+        memo = pickle.load(file)
+    if is_legacy_memo(memo):
+        raise ValueError(f"{path} holds depth-relative values; rebuild it with ReplaceTTTBuild.py")
+    return memo
+
+
+def save_table(path, memo):
+    write_table(path, *table_columns(memo))
+
+
+def table_column(path, buffer, dtype, offset, count):
+    # Read-only array at `offset` of a table file, or of a buffer holding one
+    if buffer is None:
+        return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+    column = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+    column.flags.writeable = False
+    return column
+
+
+class CompactTable:
+    # Read-only view of a table file that behaves like the memo dict. Entries
+    # added during a live search go to an in-memory overlay. Given a buffer
+    # with the file's bytes, the view is of the buffer instead.
+    def __init__(self, path, buffer=None):
+        self.path = path
+        if buffer is None:
+            with open(path, "rb") as file:
+                header = file.read(TABLE_HEADER.size)
+        else:
+            header = bytes(buffer[:TABLE_HEADER.size])
+        magic, count = TABLE_HEADER.unpack(header)
+        if magic in LEGACY_TABLE_MAGICS:
+            raise ValueError(f"{path} holds depth-relative values; rebuild it with ReplaceTTTBuild.py")
+        if magic not in (TABLE_MAGIC, TABLE_MOVES_MAGIC):
+            raise ValueError(f"{path} is not a Replace-TTT table file")
+        self.keys = table_column(path, buffer, "<u8", TABLE_HEADER.size, count)
+        self.values = table_column(path, buffer, np.int8, TABLE_HEADER.size + 8 * count, count)
+        self.moves = None
+        if magic == TABLE_MOVES_MAGIC:
+            self.moves = table_column(path, buffer, np.uint8, TABLE_HEADER.size + 9 * count, count)
+        self.overlay = {}
+
+    @property
+    def has_moves(self):
+        return self.moves is not None
+
+    def __len__(self):
+        return len(self.keys) + len(self.overlay)
+
+    def find(self, key):
+        # Index of `key` in the key array, or -1
+        index = int(np.searchsorted(self.keys, np.uint64(key)))
+        if index < len(self.keys) and self.keys[index] == key:
+            return index
+        return -1
+
+    def get(self, key, default=None):
+        value = self.overlay.get(key)
+        if value is not None:
+            return value
+        index = self.find(key)
+        return int(self.values[index]) if index >= 0 else default
+
+    def __contains__(self, key):
+        return key in self.overlay or self.find(key) >= 0
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.overlay[key] = value
+
+    def stored_move(self, key):
+        # Canonical best move code stored for `key`, or None
+        if self.moves is None:
+            return None
+        index = self.find(key)
+        if index < 0 or self.moves[index] == NO_MOVE:
+            return None
+        return int(self.moves[index])
+
+    def lookup(self, keys):
+        # Vectorized get for an array of keys: (found mask, values), with the
+        # values of missing keys set to 0. Overlay entries are not consulted.
+        keys = np.asarray(keys, dtype=np.uint64)
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=bool), np.zeros(len(keys), dtype=np.int8)
+        index = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[index] == keys
+        return found, np.where(found, self.values[index], 0).astype(np.int8)
+
+    def arrays(self, with_moves=False):
+        # Sorted keys and values, plus the stored moves when asked for;
+        # overlay entries have no move
+        columns = [self.keys, self.values] + ([self.moves] if with_moves else [])
+        if not self.overlay:
+            return tuple(np.asarray(column) for column in columns)
+        overlay_keys = np.fromiter(self.overlay.keys(), dtype=np.uint64, count=len(self.overlay))
+        overlay_values = np.fromiter(self.overlay.values(), dtype=np.int8, count=len(self.overlay))
+        overlay_columns = [overlay_keys, overlay_values, np.full(len(self.overlay), NO_MOVE, dtype=np.uint8)]
+        order = np.argsort(np.concatenate([self.keys, overlay_keys]), kind="stable")
+        return tuple(np.concatenate([column, overlay_column])[order]
+                     for column, overlay_column in zip(columns, overlay_columns))
+
+
+def merge_tables(paths, path, block=MERGE_BLOCK):
+    # k-way merge of sorted table files into one, keeping the first copy of
+    # a key. Reads `block` entries of each input at a time and streams the
+    # output, so memory stays at about 9 * block bytes per input. Returns
+    # the number of entries.
+    tables = [CompactTable(table_path) for table_path in paths]
+    cursors = [0] * len(tables)
+    count = 0
+    last_key = None
+    with open(path + ".tmp", "wb") as keys_file, open(path + ".values.tmp", "wb+") as values_file:
+        keys_file.write(TABLE_HEADER.pack(TABLE_MAGIC, 0))
+        while True:
+            live = [index for index, table in enumerate(tables) if cursors[index] < len(table.keys)]
+            if not live:
+                break
+            # Every key up to the smallest last key of the current blocks is
+            # in those blocks, so that much can be written out in order
+            frontier = min(tables[index].keys[min(cursors[index] + block, len(tables[index].keys)) - 1]
+                           for index in live)
+            keys = []
+            values = []
+            for index in live:
+                table = tables[index]
+                begin = cursors[index]
+                end = begin + int(np.searchsorted(table.keys[begin:begin + block], frontier, side="right"))
+                keys.append(table.keys[begin:end])
+                values.append(table.values[begin:end])
+                cursors[index] = end
+            keys = np.concatenate(keys)
+            values = np.concatenate(values)
+            order = np.argsort(keys, kind="stable")
+            keys = keys[order]
+            values = values[order]
+            first = np.ones(len(keys), dtype=bool)
+            first[1:] = keys[1:] != keys[:-1]
+            if last_key is not None and len(keys):
+                first[0] = keys[0] != last_key
+            keys_file.write(keys[first].astype("<u8").tobytes())
+            values_file.write(values[first].tobytes())
+            count += int(first.sum())
+            if len(keys):
+                last_key = keys[-1]
+        values_file.seek(0)
+        while True:
+            chunk = values_file.read(1 << 20)
+            if not chunk:
+                break
+            keys_file.write(chunk)
+        keys_file.seek(0)
+        keys_file.write(TABLE_HEADER.pack(TABLE_MAGIC, count))
+    os.remove(path + ".values.tmp")
+    os.replace(path + ".tmp", path)
+    return count
+
+
+def load_table(path):
+    # Open a compact, ranked or compressed table or one in shared memory, or
+    # unpickle a memo dict from any other file
+    if path.startswith(SHARED_MEMORY_PREFIX):
+        from ReplaceTTTSharedMemory import SharedMemoryTable
+        return SharedMemoryTable(path[len(SHARED_MEMORY_PREFIX):])
+    if path.endswith(TABLE_EXTENSION):
+        return CompactTable(path)
+    if path.endswith(RANKED_EXTENSION):
+        # Imported here because the ranking module imports the solver, which imports this one
+        from ReplaceTTTRanking import RankedTable
+        return RankedTable.open(path)
+    if path.endswith(COMPRESSED_EXTENSION):
+        from ReplaceTTTCompressed import CompressedTable
+        return CompressedTable(path)
+    return load_pickle(path)
+
+
+def open_table(path):
+    # Whatever backs `path`: the file itself, the pickle a missing .tb is
+    # converted from, or an empty memo. The shipped full_search_updated.pkl
+    # is a legacy memo (or a Git LFS pointer to one), so when that fallback
+    # cannot be read, warn and search live rather than fail on the first lookup.
+    if path.endswith(TABLE_EXTENSION) and not os.path.exists(path):
+        fallback = path[:-len(TABLE_EXTENSION)] + ".pkl"
+        if not os.path.exists(fallback):
+            return {}
+        try:
+            return load_pickle(fallback)
+        except (ValueError, pickle.UnpicklingError, EOFError) as error:
+            warnings.warn(f"{path} does not exist and {fallback} cannot be used ({error}); searching live "
+                          f"instead, build {path} with ReplaceTTTBuild.py", RuntimeWarning, stacklevel=2)
+            return {}
+    if os.path.exists(path) or path.startswith(SHARED_MEMORY_PREFIX):
+        return load_table(path)
+    return {}
+
+
+def save_memo(path, memo, initial_counts=None):
+    # Write a memo dict or table backend in the format the extension names
+    if isinstance(memo, SharedTable):
+        memo = memo.table
+    if path.endswith(TABLE_EXTENSION):
+        save_table(path, memo)
+    elif path.endswith(RANKED_EXTENSION):
+        from ReplaceTTTRanking import INITIAL_COUNTS, RankedTable
+        if not isinstance(memo, RankedTable):
+            memo = RankedTable.from_arrays(*memo_arrays(memo), initial_counts or INITIAL_COUNTS)
+        memo.save(path)
+    elif path.endswith(COMPRESSED_EXTENSION):
+        from ReplaceTTTCompressed import save_compressed
+        save_compressed(path, memo)
+    else:
+        if not isinstance(memo, dict):
+            memo = dict(zip(*(array.tolist() for array in memo_arrays(memo))))
+        with open(path, "wb") as file:
+            pickle.dump(memo, file)
+
+
+def convert_pickle(pickle_path, table_path):
+    memo = load_pickle(pickle_path)
+    save_table(table_path, memo)
+    return len(memo)
+
+
+class SharedTable:
+    # Process-wide handle on one table file. Every TicTacToe using the same
+    # path gets the same handle, and the file is only read on the first lookup.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.loaded = None
+
+    @property
+    def table(self):
+        if self.loaded is None:
+            with self.lock:
+                if self.loaded is None:
+                    self.loaded = open_table(self.path)
+        return self.loaded
+
+    def release(self):
+        # Drop the loaded table; the next lookup reads the file again.
+        # Entries added since it was loaded are lost unless saved first.
+        with self.lock:
+            self.loaded = None
+
+    def __len__(self):
+        return len(self.table)
+
+    def get(self, key, default=None):
+        return self.table.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.table
+
+    def __getitem__(self, key):
+        return self.table[key]
+
+    def __setitem__(self, key, value):
+        self.table[key] = value
+
+    def stored_move(self, key):
+        # Tables without moves (pickles, ranked tables) never have one
+        stored_move = getattr(self.table, "stored_move", None)
+        return stored_move(key) if stored_move is not None else None
+
+    def lookup(self, keys):
+        return memo_lookup(self.table, keys)
+
+    def arrays(self):
+        return memo_arrays(self.table)
+
+
+SHARED_TABLES = {}
+SHARED_TABLES_LOCK = threading.Lock()
+
+
+def shared_table_key(path):
+    # Files by absolute path, so any spelling of one gets the same handle
+    return path if path.startswith(SHARED_MEMORY_PREFIX) else os.path.abspath(path)
+
+
+def shared_table(path):
+    with SHARED_TABLES_LOCK:
+        path = shared_table_key(path)
+        if path not in SHARED_TABLES:
+            SHARED_TABLES[path] = SharedTable(path)
+        return SHARED_TABLES[path]
+
+
+def warm_up(path="full_search_updated" + TABLE_EXTENSION):
+    # Load a shared table now instead of on the first lookup
+    return shared_table(path).table
+
+
+def release(path=None):
+    # Unload one shared table, or all of them
+    with SHARED_TABLES_LOCK:
+        tables = list(SHARED_TABLES.values()) if path is None else [SHARED_TABLES.get(shared_table_key(path))]
+    for table in tables:
+        if table is not None:
+            table.release()
+
+
+if __name__ == "__main__":
+    # python ReplaceTTTTablebase.py full_search_updated.pkl full_search_updated.tb
+    pickle_path, table_path = sys.argv[1:3]
+    print("Converted", convert_pickle(pickle_path, table_path), "entries")
@@ -1,6 +1,37 @@
 # test_tic_tac_toe.py
+import asyncio
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
-from ReplaceTTTSolver import TicTacToe  # Replace with your actual module name
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from ReplaceTTTSolver import (
+    BOARD_MASK, MOVE_TUPLES, SIDE_SHIFT, TicTacToe, TRANSFORMATIONS,
+    canonical_forms, iterate_moves, pieces_left, position_tables
+)  # Replace with your actual module name
+from ReplaceTTTAnalysis import ILLEGAL, NO_BEST_MOVE, evaluate_positions
+from ReplaceTTTBench import compare_results, run_benchmarks
+from ReplaceTTTBuild import RetrogradeBuilder
+from ReplaceTTTCheckpoint import CLOCK_CHECK_INSERTS, CheckpointedMemo, compact_checkpoints, segment_paths
+from ReplaceTTTCompressed import CompressedTable, write_compressed
+from ReplaceTTTExternal import BloomFilter
+from ReplaceTTTRanking import RankedTable, StateRanker
+from ReplaceTTTServer import MoveServer
+from ReplaceTTTSharedMemory import SharedMemoryTable
+from ReplaceTTTStats import SearchStats
+from ReplaceTTTTablebase import TABLE_HEADER, CompactTable, load_table, release, save_memo, save_table, warm_up, write_table
+from ReplaceTTTVerify import PROBLEMS, verify_table
+
+# Reduced piece inventory that can be solved in well under a second
+SMALL_COUNTS = {
+    "X": {"s": 1, "m": 1, "l": 1},
+    "O": {"s": 1, "m": 1, "l": 1}
+}
 
 class TestTicTacToe(unittest.TestCase):
 
@@ -146,5 +177,875 @@ class TestTicTacToe(unittest.TestCase):
             result = self.game.encoded_counts(counts)
             self.assertEqual(result, expected, f"Failed for counts: {counts}. Expected: {expected}, Got: {result}")
 
+    def test_make_and_revert_move(self):
+        # Play a sequence with replacements and check the board/counts views
+        moves = [(1, 1, "s"), (1, 1, "m"), (0, 0, "l"), (1, 1, "l"), (2, 2, "s")]
+        expected_board = [["lX", " ", " "],
+                          [" ", "lO", " "],
+                          [" ", " ", "sX"]]
+        expected_counts = {
+            "X": {"s": 1, "m": 3, "l": 1},
+            "O": {"s": 3, "m": 2, "l": 1}
+        }
+
+        history = []
+        for (row, col, size) in moves:
+            history.append(self.game.make_move(row, col, size))
+
+        self.assertEqual(self.game.board, expected_board)
+        self.assertEqual(self.game.counts, expected_counts)
+        self.assertEqual(self.game.current_player, "O")
+
+        for (row, col, size), original_piece in zip(reversed(moves), reversed(history)):
+            self.game.revert_move(row, col, size, original_piece)
+
+        self.assertEqual(self.game.board, [[" " for _ in range(3)] for _ in range(3)])
+        self.assertEqual(self.game.counts, {
+            "X": {"s": 3, "m": 3, "l": 2},
+            "O": {"s": 3, "m": 3, "l": 2}
+        })
+        self.assertEqual(self.game.current_player, "X")
+
+    def test_encoded_game_state_matches_string_encoding(self):
+        # The incremental symmetry hashes must give the same key as the
+        # board_key -> encoded_board -> canonical_form -> encoded_counts path,
+        # under the side to move
+        def string_key(game):
+            board_part, counts_part = game.board_key().split("|")
+            canonical = game.canonical_form(game.encoded_board(board_part))
+            return (game.turn << SIDE_SHIFT) | int(canonical + game.encoded_counts(counts_part), 2)
+
+        moves = [(0, 0, "s"), (0, 0, "m"), (1, 1, "l"), (2, 0, "s"),
+                 (0, 0, "l"), (2, 2, "m"), (2, 0, "m"), (0, 2, "l")]
+        history = []
+        for (row, col, size) in moves:
+            history.append(self.game.make_move(row, col, size))
+            self.assertEqual(self.game.encoded_game_state(), string_key(self.game))
+
+        for (row, col, size), original_piece in zip(reversed(moves), reversed(history)):
+            self.game.revert_move(row, col, size, original_piece)
+            self.assertEqual(self.game.encoded_game_state(), string_key(self.game))
+
+    def test_move_mask_matches_replacement_rules(self):
+        rng = np.random.default_rng(3)
+        for _ in range(300):
+            self.game.reset()
+            while self.game.check_game_over() is None:
+                player = self.game.current_player
+                expected = [
+                    (row, col, size)
+                    for row in range(3) for col in range(3) for size in "sml"
+                    if self.game.counts[player][size] > 0 and (
+                        self.game.board[row][col] == " " or self.game.can_replace(self.game.board[row][col], size))
+                ]
+                self.assertEqual(self.game.get_valid_moves(), expected)
+                moves = list(iterate_moves(self.game.valid_move_mask()))
+                self.assertEqual([MOVE_TUPLES[move] for move in moves], expected)
+                self.game.play_move(moves[rng.integers(len(moves))])
+
+    def test_position_tables(self):
+        lines = [[(0, 0), (0, 1), (0, 2)], [(1, 0), (1, 1), (1, 2)], [(2, 0), (2, 1), (2, 2)],
+                 [(0, 0), (1, 0), (2, 0)], [(0, 1), (1, 1), (2, 1)], [(0, 2), (1, 2), (2, 2)],
+                 [(0, 0), (1, 1), (2, 2)], [(0, 2), (1, 1), (2, 0)]]
+        _, piece_balance, open_line_counts = position_tables()
+        rng = np.random.default_rng(4)
+        for _ in range(500):
+            self.game.reset()
+            while True:
+                board = self.game.board
+                owners = [[cell[1:] for cell in line] for line in (
+                    [board[row][col] for row, col in positions] for positions in lines)]
+                winner = next((line[0] for line in owners if line[0] and line.count(line[0]) == 3), None)
+                self.assertEqual(self.game.check_connect_3(), winner)
+
+                x, o = self.game.count_pieces_on_board().values()
+                index = (self.game.owners[0] << 9) | self.game.owners[1]
+                self.assertEqual(piece_balance[index], x - o)
+                open_lines = sum(("X" in line and "O" not in line) - ("O" in line and "X" not in line) for line in owners)
+                self.assertEqual(open_line_counts[index], open_lines)
+
+                # Settled games still go to X, whatever the piece balance
+                settled = winner is None and (self.game.is_full() or not self.game.get_valid_moves())
+                self.assertEqual(self.game.check_game_over(), winner or ("X" if settled else None))
+                if self.game.check_game_over() is not None:
+                    break
+                moves = list(iterate_moves(self.game.valid_move_mask()))
+                self.game.play_move(moves[rng.integers(len(moves))])
+
+    def test_canonical_forms_batch(self):
+        # The vectorized canonicalizer must agree with canonical_form, and the
+        # returned transformation must reproduce the canonical code
+        rng = np.random.default_rng(0)
+        cells = rng.choice([0, 1, 2, 3, 5, 6, 7], size=(500, 9))
+        board_codes = np.zeros(len(cells), dtype=np.int64)
+        for cell in range(9):
+            board_codes = (board_codes << 3) | cells[:, cell]
+
+        canonical, transform_index = canonical_forms(board_codes)
+        for board_code, canonical_code, t in zip(board_codes, canonical, transform_index):
+            board_binary = format(int(board_code), "027b")
+            self.assertEqual(self.game.canonical_form(board_binary), format(int(canonical_code), "027b"))
+
+            board_cells = [board_binary[i:i+3] for i in range(0, 27, 3)]
+            transformed = ''.join(board_cells[i] for i in TRANSFORMATIONS[t])
+            self.assertEqual(int(transformed, 2), canonical_code)
+
+class TestRetrogradeBuilder(unittest.TestCase):
+
+    def test_matches_populate_memoization_table(self):
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        game.populate_memoization_table()
+
+        builder = RetrogradeBuilder(initial_counts=SMALL_COUNTS)
+        builder.build()
+        self.assertEqual(builder.memo(), game.memo)
+        # Without a memo file there is nothing to save to
+        game.save_memoization()
+
+    def test_parallel_populate_matches_single_process(self):
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        game.populate_memoization_table()
+
+        parallel_game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        parallel_game.populate_memoization_table(jobs=3)
+        self.assertEqual(list(parallel_game.memo.items()), list(game.memo.items()))
+
+        # Only a dict memo from the empty board can take the layers, which is
+        # checked before they are built
+        table_game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path="missing.tb")
+        with self.assertRaises(ValueError):
+            table_game.populate_memoization_table(jobs=2)
+        started_game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        started_game.make_move(1, 1, "s")
+        with self.assertRaises(ValueError):
+            started_game.populate_memoization_table(jobs=2)
+
+    def test_parallel_build_splits_the_work(self):
+        # Workers share out each layer, so they expand and look up exactly
+        # as many states as one process does and build the same table
+        stats = SearchStats()
+        builder = RetrogradeBuilder(initial_counts=SMALL_COUNTS, stats=stats)
+        builder.build()
+        parallel_stats = SearchStats()
+        parallel_builder = RetrogradeBuilder(initial_counts=SMALL_COUNTS, stats=parallel_stats, jobs=3)
+        parallel_builder.build()
+        for arrays, parallel_arrays in zip(builder.table_arrays(), parallel_builder.table_arrays()):
+            np.testing.assert_array_equal(arrays, parallel_arrays)
+        self.assertEqual(parallel_stats.nodes_per_depth, stats.nodes_per_depth)
+        self.assertEqual(parallel_stats.memo_hits, stats.memo_hits)
+        self.assertEqual(parallel_stats.terminal_hits, stats.terminal_hits)
+
+    def test_values_do_not_depend_on_search_root(self):
+        # A search from the middle of a game stores the same values the
+        # builder finds from the start, so one table serves every position
+        builder = RetrogradeBuilder(initial_counts=SMALL_COUNTS)
+        builder.build()
+        memo = builder.memo()
+        for moves in [[(1, 1, "s")], [(0, 0, "m"), (1, 1, "l"), (2, 2, "s")]]:
+            game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+            for move in moves:
+                game.make_move(*move)
+            game.best_move()
+            self.assertTrue(game.memo)
+            for key, value in game.memo.items():
+                self.assertEqual(value, memo[key])
+
+
+class TestCheckpoints(unittest.TestCase):
+
+    def test_resume_after_crash_and_compact(self):
+        reference = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        reference.populate_memoization_table()
+
+        class Crash(Exception):
+            pass
+
+        class CrashingStats(SearchStats):
+            # Kills the build partway through, like an OOM would
+            def visit(self, depth):
+                super().visit(depth)
+                if sum(self.nodes_per_depth.values()) > 20000:
+                    raise Crash
+
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoints = os.path.join(directory, "checkpoints")
+            game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None, stats=CrashingStats())
+            with self.assertRaises(Crash):
+                game.populate_memoization_table(checkpoint_dir=checkpoints, checkpoint_entries=1000)
+            saved = len(segment_paths(checkpoints))
+            self.assertGreater(saved, 0)
+
+            stats = SearchStats()
+            game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None, stats=stats)
+            game.populate_memoization_table(checkpoint_dir=checkpoints, checkpoint_entries=1000)
+            self.assertEqual(game.memo, reference.memo)
+            # The resumed run only searched what the checkpoints were missing
+            self.assertLess(stats.memo_misses - stats.terminal_hits, len(reference.memo))
+            self.assertGreater(len(segment_paths(checkpoints)), saved)
+
+            path = os.path.join(directory, "table.tb")
+            self.assertEqual(compact_checkpoints(checkpoints, path), len(reference.memo))
+            self.assertEqual(segment_paths(checkpoints), [])
+            table = CompactTable(path)
+            self.assertEqual(dict(zip(*(array.tolist() for array in table.arrays()))), reference.memo)
+
+            # Parallel workers would leave nothing to checkpoint until the end
+            with self.assertRaises(ValueError):
+                TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None).populate_memoization_table(
+                    jobs=2, checkpoint_dir=checkpoints)
+
+    def test_clock_is_read_every_few_inserts(self):
+        with tempfile.TemporaryDirectory() as directory:
+            memo = CheckpointedMemo(directory, every_seconds=0)
+            for key in range(CLOCK_CHECK_INSERTS - 1):
+                memo[key] = 0
+            self.assertEqual(segment_paths(directory), [])
+            memo[CLOCK_CHECK_INSERTS] = 0
+            self.assertEqual(len(segment_paths(directory)), 1)
+
+
+class TestExternalBuild(unittest.TestCase):
+
+    def test_build_under_memory_budget(self):
+        reference = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        reference.populate_memoization_table()
+
+        with tempfile.TemporaryDirectory() as directory:
+            game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+            game.populate_memoization_table(spill_dir=os.path.join(directory, "spill"), max_memory=1 << 19)
+            self.assertGreater(len(game.memo.runs), 2)
+            self.assertLessEqual(len(game.memo.entries), game.memo.max_entries)
+            self.assertEqual(len(game.memo), len(reference.memo))
+            for key in list(reference.memo)[::100]:
+                self.assertEqual(game.memo[key], reference.memo[key])
+            self.assertEqual(game.best_move(), reference.best_move())
+
+            path = os.path.join(directory, "table.tb")
+            self.assertEqual(game.memo.save(path), len(reference.memo))
+            self.assertEqual(os.listdir(os.path.join(directory, "spill")), [])
+            table = CompactTable(path)
+            self.assertEqual(dict(zip(*(array.tolist() for array in table.arrays()))), reference.memo)
+
+            # Without a spill_dir the runs go to a temporary directory that save() removes
+            game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+            game.populate_memoization_table(max_memory=1 << 19)
+            spill_dir = game.memo.directory
+            self.assertTrue(os.path.isdir(spill_dir))
+            self.assertEqual(game.memo.save(os.path.join(directory, "temporary.tb")), len(reference.memo))
+            self.assertFalse(os.path.exists(spill_dir))
+
+    def test_bloom_filter(self):
+        rng = np.random.default_rng(5)
+        keys = rng.integers(0, 1 << 40, size=20000, dtype=np.int64)
+        bloom = BloomFilter(keys)
+        self.assertTrue(all(int(key) in bloom for key in keys))
+        others = rng.integers(1 << 40, 1 << 41, size=20000, dtype=np.int64)
+        self.assertLess(sum(int(key) in bloom for key in others), 600)
+
+
+class TestCompactTable(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "table.tb")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip_and_search(self):
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        game.populate_memoization_table()
+        save_table(self.path, game.memo)
+
+        table = CompactTable(self.path)
+        self.assertEqual(len(table), len(game.memo))
+        for key, value in game.memo.items():
+            self.assertEqual(table[key], value)
+        self.assertNotIn(max(game.memo) + 1, table)
+
+        keys = np.array(list(game.memo) + [max(game.memo) + 1], dtype=np.uint64)
+        found, values = table.lookup(keys)
+        self.assertEqual(found.tolist(), [True] * len(game.memo) + [False])
+        self.assertEqual(values[:-1].tolist(), list(game.memo.values()))
+
+        # New entries from a live search land in the overlay and are saved with the rest
+        table[max(game.memo) + 1] = 3
+        self.assertEqual(table[max(game.memo) + 1], 3)
+        save_table(self.path, table)
+        self.assertEqual(CompactTable(self.path)[max(game.memo) + 1], 3)
+
+    def test_solver_uses_compact_table(self):
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        game.populate_memoization_table()
+        save_table(self.path, game.memo)
+
+        table_game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=self.path)
+        self.assertIsInstance(table_game.memo.table, CompactTable)
+        self.assertEqual(table_game.best_move(), game.best_move())
+        self.assertEqual(len(table_game.memo.table.overlay), 0)
+        release(self.path)
+
+    def test_stored_moves_are_optimal(self):
+        builder = RetrogradeBuilder(initial_counts=SMALL_COUNTS)
+        builder.build()
+        write_table(self.path, *builder.table_arrays())
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=self.path)
+
+        def child_value(move):
+            original_piece = game.make_move(*move)
+            value = game.memo.get(game.encoded_game_state())
+            if value is None:
+                value = game.terminal_value()
+            game.revert_move(*move, original_piece)
+            return value
+
+        # Every stored state, reached in whatever orientation the search meets
+        # it first, so most canonical boards are a rotation or reflection of it
+        visited = set()
+
+        def visit(pieces_played):
+            if game.check_game_over() is not None or game.encoded_game_state() in visited:
+                return
+            visited.add(game.encoded_game_state())
+            moves = game.get_valid_moves()
+            if pieces_played:
+                move = game.stored_move()
+                self.assertIn(move, moves)
+                values = [child_value(valid_move) for valid_move in moves]
+                best = max(values) if game.current_player == "X" else min(values)
+                self.assertEqual(child_value(move), best)
+            for valid_move in moves:
+                original_piece = game.make_move(*valid_move)
+                visit(pieces_played + 1)
+                game.revert_move(*valid_move, original_piece)
+
+        visit(0)
+        self.assertEqual(len(game.memo.table.overlay), 0)
+        release(self.path)
+
+    def test_legacy_table_is_rejected(self):
+        # Tables with root-relative values have to be rebuilt
+        with open(self.path, "wb") as file:
+            file.write(TABLE_HEADER.pack(b"RTTTTB01", 0))
+        with self.assertRaises(ValueError):
+            CompactTable(self.path)
+
+    def test_unusable_legacy_pickle_falls_back_to_live_search(self):
+        # The default table falls back to the legacy pickle when it is
+        # missing, and a game must still play when that cannot be read
+        reference = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        pickle_path = self.path[:-len(".tb")] + ".pkl"
+        for contents in [b"version https://git-lfs.github.com/spec/v1\n", pickle.dumps({5: 3, 7: -100})]:
+            with open(pickle_path, "wb") as file:
+                file.write(contents)
+            game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=self.path)
+            with self.assertWarns(RuntimeWarning):
+                self.assertEqual(game.best_move(), reference.best_move())
+            release(self.path)
+
+        # The CLI and GUI players then think within a time budget
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=self.path)
+        start = time.perf_counter()
+        with self.assertWarns(RuntimeWarning):
+            move = game.player_move(time_budget_ms=50)
+        self.assertLess(time.perf_counter() - start, 1)
+        self.assertIn(move, game.get_valid_moves())
+        self.assertEqual(len(game.memo), 0)
+        release(self.path)
+
+
+class TestCompressedTable(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "table.ctb")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip_and_solver(self):
+        builder = RetrogradeBuilder(initial_counts=SMALL_COUNTS)
+        builder.build()
+        keys, values, moves = builder.table_arrays()
+        compact_path = os.path.join(self.directory.name, "table.tb")
+        write_table(compact_path, keys, values, moves)
+        # Small blocks, so lookups cross many of them
+        write_compressed(self.path, keys, values, moves, block_size=16)
+
+        table = CompressedTable(self.path)
+        compact = CompactTable(compact_path)
+        for column, expected in zip(table.arrays(with_moves=True), (keys, values, moves)):
+            self.assertEqual(column.tolist(), expected.tolist())
+        for key in keys.tolist():
+            self.assertEqual(table[key], compact[key])
+            self.assertEqual(table.stored_move(key), compact.stored_move(key))
+        self.assertNotIn(int(keys[-1]) + 1, table)
+        found, found_values = table.lookup(np.append(keys, keys[-1] + np.uint64(1)))
+        self.assertEqual(found.tolist(), [True] * len(keys) + [False])
+        self.assertEqual(found_values[:-1].tolist(), values.tolist())
+
+        # Rare values fall outside the palette and are stored whole
+        rare = np.where(np.arange(1000) % 97 == 0, np.arange(1000) % 50, 99).astype(np.int8)
+        write_compressed(self.path + ".rare", np.arange(0, 3000, 3, dtype=np.uint64), rare, block_size=64)
+        self.assertEqual(CompressedTable(self.path + ".rare").arrays()[1].tolist(), rare.tolist())
+
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=self.path)
+        compact_game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=compact_path)
+        self.assertIsInstance(game.memo.table, CompressedTable)
+        self.assertEqual(game.best_move(), compact_game.best_move())
+        release(self.path)
+        release(compact_path)
+
+
+class TestVerifyTable(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_clean_and_corrupted_tables(self):
+        builder = RetrogradeBuilder(initial_counts=SMALL_COUNTS)
+        builder.build()
+        keys, values, moves = builder.table_arrays()
+        path = os.path.join(self.directory.name, "table.tb")
+        write_table(path, keys, values, moves)
+        report = verify_table(path, jobs=2, initial_counts=SMALL_COUNTS, block=1000)
+        self.assertEqual([report[problem] for problem in PROBLEMS], [0] * len(PROBLEMS))
+        self.assertEqual(report["entries"], len(keys))
+
+        # A pickled memo from minimax has no moves but the same values
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        game.populate_memoization_table()
+        pickle_path = os.path.join(self.directory.name, "table.pkl")
+        save_memo(pickle_path, game.memo)
+        report = verify_table(pickle_path, initial_counts=SMALL_COUNTS)
+        self.assertEqual([report[problem] for problem in PROBLEMS], [0] * len(PROBLEMS))
+
+        # A wrong value and an impossible move in the last layer, where no
+        # entry is another's child, and an entry dropped from the layer above
+        last_layer = np.flatnonzero(pieces_left(keys & 0xFFF) == 1)
+        wrong_value, wrong_move = last_layer[:2]
+        dropped = np.flatnonzero(pieces_left(keys & 0xFFF) == 2)[0]
+        values = values.copy()
+        moves = moves.copy()
+        values[wrong_value] = -values[wrong_value]
+        moves[wrong_move] = 30
+        keep = np.arange(len(keys)) != dropped
+        corrupt_path = os.path.join(self.directory.name, "corrupt.tb")
+        write_table(corrupt_path, keys[keep], values[keep], moves[keep])
+        report = verify_table(corrupt_path, initial_counts=SMALL_COUNTS)
+        problems = {(example["problem"], example["key"]) for example in report["examples"]}
+        self.assertGreaterEqual(report["value"], 1)
+        self.assertIn(("value", int(keys[wrong_value])), problems)
+        self.assertEqual(report["move"], 1)
+        self.assertIn(("move", int(keys[wrong_move])), problems)
+        self.assertGreaterEqual(report["missing_child"], 1)
+        self.assertEqual(report["not_canonical"] + report["wrong_side"] + report["finished"], 0)
+        release(path)
+        release(pickle_path)
+        release(corrupt_path)
+
+
+class TestMoveServer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_batched_answers_match_the_engine(self):
+        builder = RetrogradeBuilder(initial_counts=SMALL_COUNTS)
+        builder.build()
+        keys, values, moves = builder.table_arrays()
+        table_path = os.path.join(self.directory.name, "table.tb")
+        write_table(table_path, keys, values, moves)
+        # Without stored moves every best_move goes through the batch
+        pickle_path = os.path.join(self.directory.name, "table.pkl")
+        save_memo(pickle_path, CompactTable(table_path))
+        positions = [(int(key >> 12) & BOARD_MASK, int(key) & 0xFFF) for key in keys[::7]]
+
+        for path in (table_path, pickle_path):
+            server = MoveServer(path, initial_counts=SMALL_COUNTS)
+            requests = [{"id": index, "op": op, "board": board, "counts": counts}
+                        for index, (board, counts) in enumerate(positions) for op in ("best_move", "evaluate")]
+
+            async def run():
+                responses = await asyncio.gather(*(server.answer(request) for request in requests))
+                errors = [await server.answer_line("not json"), await server.answer_line('{"op": "undo"}')]
+                # Positions no game reaches would send the worker into a live search
+                for board, counts in [(0, 4095), (4, positions[0][1]), (True, positions[0][1]),
+                                      (positions[0][0], positions[0][1] ^ 1)]:
+                    errors.append(await server.answer_line(json.dumps({"op": "evaluate", "board": board,
+                                                                       "counts": counts})))
+                stats = await server.answer({"op": "stats"})
+                await server.close()
+                return responses, errors, stats
+
+            responses, errors, stats = asyncio.run(run())
+            expected_values, _, expected_move_values = evaluate_positions(
+                [board for board, _ in positions], [counts for _, counts in positions],
+                memo_file_path=path, initial_counts=SMALL_COUNTS)
+            game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=path)
+            for request, response in zip(requests, responses):
+                self.assertEqual(response["id"], request["id"])
+                self.assertEqual(response["value"], expected_values[request["id"]])
+                if request["op"] == "best_move":
+                    game.load_position(request["board"], request["counts"])
+                    self.assertEqual(tuple(response["move"]), game.best_move())
+                else:
+                    self.assertEqual([ILLEGAL if value is None else value for value in response["move_values"]],
+                                     expected_move_values[request["id"]].tolist())
+            self.assertTrue(all("error" in json.loads(error) for error in errors))
+            self.assertEqual(stats["requests"], len(requests))
+            self.assertLess(stats["batches"], len(requests))
+            self.assertLessEqual(stats["p50_ms"], stats["p99_ms"])
+            release(path)
+
+
+def shared_lookup(path, keys):
+    # Worker for TestSharedMemoryTable: attach to the table and look keys up
+    found, values = load_table(path).lookup(keys)
+    return found.tolist(), values.tolist()
+
+
+class TestSharedMemoryTable(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_workers_attach_to_one_copy(self):
+        builder = RetrogradeBuilder(initial_counts=SMALL_COUNTS)
+        builder.build()
+        keys, values, moves = builder.table_arrays()
+        table_path = os.path.join(self.directory.name, "table.tb")
+        write_table(table_path, keys, values, moves)
+        pickle_path = os.path.join(self.directory.name, "table.pkl")
+        save_memo(pickle_path, CompactTable(table_path))
+
+        shared = SharedMemoryTable.create(table_path)
+        self.assertEqual(shared.arrays(with_moves=True)[2].tolist(), moves.tolist())
+        with self.assertRaises(ValueError):
+            shared.values[0] = 0
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            results = list(executor.map(shared_lookup, [shared.path] * 2, np.array_split(keys, 2)))
+        self.assertEqual(sum((found for found, _ in results), []), [True] * len(keys))
+        self.assertEqual(sum((found_values for _, found_values in results), []), values.tolist())
+
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=shared.path)
+        file_game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=table_path)
+        self.assertIsInstance(game.memo.table, SharedMemoryTable)
+        self.assertEqual(game.best_move(), file_game.best_move())
+        release(shared.path)
+        release(table_path)
+        shared.unlink()
+        with self.assertRaises(FileNotFoundError):
+            load_table(shared.path)
+
+        # Workers verifying a pickle share one copy of it
+        report = verify_table(pickle_path, jobs=2, initial_counts=SMALL_COUNTS, block=1000)
+        self.assertEqual([report[problem] for problem in PROBLEMS], [0] * len(PROBLEMS))
+        self.assertEqual(report["entries"], len(keys))
+
+    def test_block_outlives_an_unrelated_process(self):
+        # A process not started from the creator has its own resource
+        # tracker, which must not unlink the block when that process exits
+        builder = RetrogradeBuilder(initial_counts=SMALL_COUNTS)
+        builder.build()
+        keys, values, _ = builder.table_arrays()
+        shared = SharedMemoryTable.create(builder.memo())
+        script = ("import sys; from ReplaceTTTSharedMemory import SharedMemoryTable; "
+                  "table = SharedMemoryTable(sys.argv[1]); print(int(table.values.sum())); table.close()")
+        result = subprocess.run([sys.executable, "-c", script, shared.memory.name], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        self.assertEqual(int(result.stdout), int(values.astype(np.int64).sum()))
+        self.assertEqual(result.stderr, "")
+        attached = SharedMemoryTable(shared.memory.name)
+        self.assertEqual(attached.keys.tolist(), keys.tolist())
+        attached.close()
+        shared.unlink()
+
+
+class TestStateRanker(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.ranker = StateRanker(SMALL_COUNTS)
+        builder = RetrogradeBuilder(initial_counts=SMALL_COUNTS)
+        builder.enumerate_layers()
+        cls.keys = np.concatenate(list(builder.keys.values()))
+
+    def test_reachable_states_rank_densely(self):
+        ranks = self.ranker.rank(self.keys)
+        self.assertTrue((ranks >= 0).all())
+        self.assertEqual(len(np.unique(ranks)), len(self.keys))
+        self.assertLess(ranks.max(), self.ranker.size)
+        self.assertEqual(self.ranker.unrank(ranks).tolist(), self.keys.tolist())
+        self.assertEqual([self.ranker.rank_one(int(key)) for key in self.keys[::50]], ranks[::50].tolist())
+        # The side to move follows from the counts, so a key claiming the other side is not ranked
+        flipped = self.keys ^ (1 << SIDE_SHIFT)
+        self.assertTrue((self.ranker.rank(flipped) == -1).all())
+        self.assertEqual(self.ranker.rank_one(int(flipped[1])), -1)
+
+    def test_unrank_covers_every_index(self):
+        ranks = np.arange(self.ranker.size)
+        self.assertEqual(self.ranker.rank(self.ranker.unrank(ranks)).tolist(), ranks.tolist())
+
+    def test_ranked_table_as_memo(self):
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        game.populate_memoization_table()
+        table = RankedTable.from_memo(game.memo, SMALL_COUNTS, self.ranker)
+        self.assertEqual(len(table), len(game.memo))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "table.rtb")
+            table.save(path)
+            table_game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=path)
+            self.assertIsInstance(table_game.memo.table, RankedTable)
+            for key, value in game.memo.items():
+                self.assertEqual(table_game.memo[key], value)
+            self.assertEqual(table_game.best_move(), game.best_move())
+            release(path)
+
+
+class TestSharedTable(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "table.tb")
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        game.populate_memoization_table()
+        save_table(self.path, game.memo)
+        self.expected_move = game.best_move()
+
+    def tearDown(self):
+        release(self.path)
+        self.directory.cleanup()
+
+    def test_loaded_once_on_first_lookup(self):
+        first = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=self.path)
+        second = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=self.path)
+        self.assertIs(first.memo, second.memo)
+        self.assertIsNone(first.memo.loaded)
+
+        self.assertEqual(first.best_move(), self.expected_move)
+        self.assertIsInstance(second.memo.loaded, CompactTable)
+
+        release(self.path)
+        self.assertIsNone(second.memo.loaded)
+        self.assertEqual(second.best_move(), self.expected_move)
+
+    def test_warm_up(self):
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=self.path)
+        self.assertIs(warm_up(self.path), game.memo.loaded)
+
+
+class TestTranspositionTable(unittest.TestCase):
+
+    def test_bounded_table_gives_the_same_moves_and_values(self):
+        builder = RetrogradeBuilder(initial_counts=SMALL_COUNTS)
+        builder.build()
+        memo = builder.memo()
+        reference = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        reference.make_move(1, 1, "s")
+        expected_move = reference.best_move()
+        for replacement in ("depth", "always"):
+            for search in ("minimax", "alphabeta"):
+                game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None, memo_entries=300, replacement=replacement)
+                game.make_move(1, 1, "s")
+                self.assertEqual(game.best_move(search=search), expected_move)
+                # More states were searched than fit, and the exact values kept are right
+                self.assertLessEqual(len(game.memo), 300)
+                keys, values = game.memo.arrays()
+                self.assertTrue(len(keys))
+                for key, value in zip(keys.tolist(), values.tolist()):
+                    self.assertEqual(value, memo[key])
+                found, found_values = game.memo.lookup(keys)
+                self.assertTrue(found.all())
+                self.assertEqual(found_values.tolist(), values.tolist())
+        self.assertGreater(len(reference.memo), 300)
+
+
+class TestAlphaBeta(unittest.TestCase):
+
+    def test_same_moves_and_values_as_minimax(self):
+        openings = [[], [(1, 1, "s")], [(0, 0, "l"), (1, 1, "m")], [(0, 1, "m"), (0, 1, "l"), (2, 2, "s")]]
+        for moves in openings:
+            games = [TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None) for _ in range(2)]
+            for game in games:
+                for move in moves:
+                    game.make_move(*move)
+            reference, game = games
+            self.assertEqual(game.best_move(search="alphabeta"), reference.best_move(), moves)
+            # Only exact values reach the memo, and they agree with minimax
+            for key, value in game.memo.items():
+                self.assertEqual(value, reference.memo[key])
+
+    def test_ordered_moves(self):
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        game.board = [["sX", "mX", " "],
+                      [" ", "sO", " "],
+                      ["mO", " ", " "]]
+        game.counts = {"X": {"s": 0, "m": 0, "l": 1}, "O": {"s": 0, "m": 0, "l": 1}}
+        moves = [MOVE_TUPLES[move] for move in game.ordered_moves()]
+        self.assertEqual(sorted(moves), sorted(game.get_valid_moves()))
+        # Completing the top row comes first, then taking O's winning cell
+        # (0, 2) is both, then the replacements of O's pieces
+        self.assertEqual(moves[0], (0, 2, "l"))
+        self.assertEqual(moves[1:3], [(1, 1, "l"), (2, 0, "l")])
+
+
+class TestTimedBestMove(unittest.TestCase):
+
+    def test_budget_without_table(self):
+        game = TicTacToe(memo_file_path=None)
+        game.make_move(1, 1, "m")
+        start = time.monotonic()
+        move = game.best_move(time_budget_ms=50)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertIn(move, game.get_valid_moves())
+        # The interrupted search leaves the position as it was
+        self.assertEqual(game.board[1][1], "mX")
+        self.assertEqual(game.current_player, "O")
+        self.assertEqual(sum(game.counts["X"].values()), 7)
+        self.assertEqual(game.memo, {})
+
+    def test_enough_budget_finds_an_optimal_move(self):
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        game.make_move(0, 0, "s")
+        move = game.best_move(time_budget_ms=60000)
+
+        values = {}
+        for (row, col, size) in game.get_valid_moves():
+            original_piece = game.make_move(row, col, size)
+            values[(row, col, size)] = game.minimax(0, True)
+            game.revert_move(row, col, size, original_piece)
+        self.assertEqual(values[move], min(values.values()))
+
+
+class TestEvaluatePositions(unittest.TestCase):
+
+    def test_table_and_live_search_agree(self):
+        builder = RetrogradeBuilder(initial_counts=SMALL_COUNTS)
+        builder.build()
+        keys = np.concatenate([builder.keys[pieces_left] for pieces_left in range(6)])
+        expected = np.concatenate([builder.values[pieces_left] for pieces_left in range(6)])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "table.tb")
+            write_table(path, *builder.table_arrays())
+            from_table = evaluate_positions((keys >> 12) & BOARD_MASK, keys & 0xFFF, memo_file_path=path, initial_counts=SMALL_COUNTS)
+            release(path)
+        live = evaluate_positions((keys >> 12) & BOARD_MASK, keys & 0xFFF, memo_file_path=None, initial_counts=SMALL_COUNTS)
+
+        for table_result, live_result in zip(from_table, live):
+            self.assertTrue(np.array_equal(table_result, live_result))
+        values, best_moves, move_values = from_table
+        self.assertTrue(np.array_equal(values, expected))
+        open_positions = best_moves != NO_BEST_MOVE
+        self.assertTrue(np.array_equal(move_values[open_positions, best_moves[open_positions]], values[open_positions]))
+
+    def test_side_to_move_must_match(self):
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        game.make_move(1, 1, "s")
+        with self.assertRaises(ValueError):
+            evaluate_positions([game.symmetry_hashes[0]], [game.packed_counts], sides=[0],
+                               memo_file_path=None, initial_counts=SMALL_COUNTS)
+
+
+class TestSearchStats(unittest.TestCase):
+
+    def test_minimax_counters(self):
+        stats = SearchStats()
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None, stats=stats)
+        game.populate_memoization_table()
+
+        self.assertEqual(sum(stats.nodes_per_depth.values()), stats.memo_hits + stats.memo_misses)
+        # Every miss is either a finished game or a new memo entry
+        self.assertEqual(stats.memo_misses, stats.terminal_hits + len(game.memo))
+        self.assertEqual(stats.peak_memo_size, len(game.memo))
+        self.assertEqual(stats.nodes_per_depth[0], len(game.get_valid_moves()))
+
+        exported = json.loads(stats.to_json())
+        self.assertEqual(exported["nodes"], sum(stats.nodes_per_depth.values()))
+        self.assertIn("populate", exported["phase_seconds"])
+
+    def test_builder_counters(self):
+        stats = SearchStats()
+        builder = RetrogradeBuilder(initial_counts=SMALL_COUNTS, stats=stats)
+        builder.build()
+        for pieces_left, keys in builder.keys.items():
+            self.assertEqual(stats.nodes_per_depth[builder.depth(pieces_left)], len(keys))
+        self.assertEqual(stats.peak_memo_size, sum(len(keys) for keys in builder.keys.values()))
+        self.assertEqual(stats.terminal_hits, sum(len(keys) for keys in builder.keys.values()) - len(builder.memo()) - 1)
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_compare_results(self):
+        baseline = {
+            "check_game_over": {"value": 400.0, "unit": "ns/call", "higher_is_better": False},
+            "train_agent": {"value": 8000.0, "unit": "episodes/s", "higher_is_better": True},
+        }
+        results = run_benchmarks(["check_game_over"], repeats=1)
+        self.assertEqual(results["check_game_over"]["unit"], "ns/call")
+
+        results = {
+            "check_game_over": {"value": 500.0, "unit": "ns/call", "higher_is_better": False},
+            "train_agent": {"value": 9000.0, "unit": "episodes/s", "higher_is_better": True},
+            "canonical_form": {"value": 1.0, "unit": "ns/call", "higher_is_better": False},
+        }
+        changes, regressions = compare_results(results, baseline)
+        self.assertAlmostEqual(changes["check_game_over"], 0.25)
+        self.assertAlmostEqual(changes["train_agent"], -0.125)
+        self.assertNotIn("canonical_form", changes)
+        self.assertEqual(regressions, ["check_game_over"])
+        self.assertEqual(compare_results(results, baseline, thresholds={"check_game_over": 0.3})[1], [])
+
+        # A zero baseline gives an infinite change instead of dividing by zero
+        baseline["check_game_over"]["value"] = 0.0
+        baseline["train_agent"]["value"] = 0.0
+        changes, regressions = compare_results(results, baseline)
+        self.assertEqual(changes["check_game_over"], float("inf"))
+        self.assertEqual(changes["train_agent"], float("-inf"))
+        self.assertEqual(regressions, ["check_game_over"])
+        self.assertEqual(compare_results(baseline, baseline)[0]["check_game_over"], 0.0)
+
+
+class TestPerft(unittest.TestCase):
+
+    def test_counts(self):
+        game = TicTacToe(memo_file_path=None)
+        self.assertEqual(game.perft(0)["nodes"], 1)
+        self.assertEqual(game.perft(1)["nodes"], 27)
+        # Every second move has 25 replies: 8 empty cells with all sizes, plus
+        # the two sizes larger than a small piece or one larger than a medium
+        self.assertEqual(game.perft(2)["nodes"], 9 * (24 + 2) + 9 * (24 + 1) + 9 * 24)
+
+        divided = game.perft_divide(3)
+        self.assertEqual(sorted(divided), sorted(game.get_valid_moves()))
+        self.assertEqual(sum(counts["nodes"] for counts in divided.values()), game.perft(3)["nodes"])
+        self.assertEqual(game.board, [[" "] * 3 for _ in range(3)])
+
+    def test_unique_counts_match_builder_layers(self):
+        builder = RetrogradeBuilder(initial_counts=SMALL_COUNTS)
+        builder.enumerate_layers()
+        game = TicTacToe(initial_counts=SMALL_COUNTS, memo_file_path=None)
+        for depth in range(7):
+            counts = game.perft_unique(depth)
+            self.assertEqual(counts["nodes"], len(builder.keys[6 - depth]))
+            for winner, outcome in (("X", 1), ("O", 2)):
+                finished = sum(int((builder.outcomes[6 - ply] == outcome).sum()) for ply in range(1, depth + 1))
+                self.assertEqual(counts[winner], finished)
+            # Sequences that finish early are not played on in either count
+            if depth <= 4:
+                self.assertLessEqual(counts["nodes"], game.perft(depth)["nodes"])
+
+
 if __name__ == '__main__':
     unittest.main()
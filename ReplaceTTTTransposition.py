@@ -0,0 +1,151 @@
+import numpy as np
+
+# Flag of exact entries; alpha-beta bounds keep the solver's LOWER_BOUND and
+# UPPER_BOUND flags
+EXACT = 0
+# Key of an empty slot, never a state key (those stay below 1 << 40)
+EMPTY = np.uint64((1 << 64) - 1)
+# Slots searched from a key's home slot before something has to be replaced
+PROBES = 4
+# Fibonacci hashing spreads the structured state keys over the slots
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+HASH_MASK = (1 << 64) - 1
+REPLACEMENTS = ("depth", "always")
+
+
+class TranspositionTable:
+    # Memo backend of a fixed number of entries, for live searches that must
+    # stay under a memory ceiling. Four preallocated arrays hold the key, the
+    # value, the bound flag and the depth of each entry: 11 bytes an entry,
+    # against about 100 for a dict item. A key lives in one of PROBES slots
+    # from its home slot. When they are all taken, "depth" replaces the
+    # shallowest entry unless the new one is shallower still, and "always"
+    # replaces whatever is in the home slot. An entry's depth is the number
+    # of pieces its state has left, which bounds the plies its value took
+    # to search. Lost entries are searched again, so any size gives the same
+    # values, only slower.
+    def __init__(self, entries, replacement="depth"):
+        if entries < 1:
+            raise ValueError("a transposition table needs at least one entry")
+        if replacement not in REPLACEMENTS:
+            raise ValueError(f"replacement must be one of {', '.join(REPLACEMENTS)}")
+        self.size = entries
+        self.replacement = replacement
+        self.keys = np.full(entries, EMPTY, dtype=np.uint64)
+        self.values = np.zeros(entries, dtype=np.int8)
+        self.bounds = np.zeros(entries, dtype=np.uint8)
+        self.depths = np.zeros(entries, dtype=np.uint8)
+        self.filled = 0
+        self.bound_entries = BoundEntries(self)
+
+    def home(self, key):
+        return (((key * HASH_MULTIPLIER) & HASH_MASK) >> 32) % self.size
+
+    def find(self, key):
+        # Slot holding `key`, or -1
+        slot = self.home(key)
+        for _ in range(min(PROBES, self.size)):
+            if self.keys[slot] == key:
+                return slot
+            slot = slot + 1 if slot + 1 < self.size else 0
+        return -1
+
+    def store(self, key, value, bound):
+        # Put an entry in the first free slot of the key's probe window, or
+        # in place of the victim the replacement policy picks
+        depth = sum((key >> shift) & 3 for shift in range(0, 12, 2))
+        home = slot = self.home(key)
+        victim = None
+        shallowest = home
+        for _ in range(min(PROBES, self.size)):
+            stored = self.keys[slot]
+            if stored == key or stored == EMPTY:
+                victim = slot
+                break
+            if self.depths[slot] < self.depths[shallowest]:
+                shallowest = slot
+            slot = slot + 1 if slot + 1 < self.size else 0
+        if victim is None:
+            if self.replacement == "always":
+                victim = home
+            elif depth < self.depths[shallowest]:
+                return
+            else:
+                victim = shallowest
+        if self.keys[victim] == EMPTY:
+            self.filled += 1
+        self.keys[victim] = key
+        self.values[victim] = value
+        self.bounds[victim] = bound
+        self.depths[victim] = depth
+
+    def __len__(self):
+        # Slots in use, bounds included
+        return self.filled
+
+    def get(self, key, default=None):
+        slot = self.find(key)
+        if slot < 0 or self.bounds[slot] != EXACT:
+            return default
+        return int(self.values[slot])
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.store(key, value, EXACT)
+
+    def update(self, memo):
+        for key, value in memo.items():
+            self.store(key, value, EXACT)
+
+    def stored_move(self, key):
+        # Live entries have no best move
+        return None
+
+    def lookup(self, keys):
+        # Vectorized get: (found mask, values), with the values of missing keys set to 0
+        keys = np.asarray(keys, dtype=np.uint64)
+        slots = (((keys * np.uint64(HASH_MULTIPLIER)) >> np.uint64(32)) % np.uint64(self.size)).astype(np.int64)
+        found = np.zeros(len(keys), dtype=bool)
+        values = np.zeros(len(keys), dtype=np.int8)
+        for _ in range(min(PROBES, self.size)):
+            hit = (self.keys[slots] == keys) & (self.bounds[slots] == EXACT)
+            values[hit] = self.values[slots[hit]]
+            found |= hit
+            slots = np.where(slots + 1 < self.size, slots + 1, 0)
+        return found, values
+
+    def arrays(self):
+        # Sorted keys and values of the exact entries
+        exact = (self.keys != EMPTY) & (self.bounds == EXACT)
+        order = np.argsort(self.keys[exact], kind="stable")
+        return self.keys[exact][order], self.values[exact][order]
+
+
+class BoundEntries:
+    # The alpha-beta bounds of a TranspositionTable, shaped like the solver's
+    # bounds dict: key -> (flag, value). They share the slots with exact values.
+    def __init__(self, table):
+        self.table = table
+
+    def get(self, key, default=None):
+        table = self.table
+        slot = table.find(key)
+        if slot < 0 or table.bounds[slot] == EXACT:
+            return default
+        return int(table.bounds[slot]), int(table.values[slot])
+
+    def __setitem__(self, key, entry):
+        flag, value = entry
+        self.table.store(key, value, flag)
+
+    def pop(self, key, default=None):
+        # Exact values overwrite a key's bound in place, so there is nothing to remove
+        return self.get(key, default)
@@ -0,0 +1,173 @@
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+from ReplaceTTTAnalysis import MOVE_COUNT, evaluate_chunk
+from ReplaceTTTBuild import CHUNK_SIZE, NOT_OVER, game_outcomes, key_boards, total_pieces
+from ReplaceTTTSharedMemory import SharedMemoryTable
+from ReplaceTTTSolver import INITIAL_COUNTS, SIDE_SHIFT, TicTacToe, canonical_forms, pieces_left
+from ReplaceTTTTablebase import NO_MOVE, CompactTable, release, shared_table, table_columns
+
+# What verify_table checks every stored entry for:
+#   value          the stored value is not the max (X) or min (O) over its
+#                  children's values one ply back, as minimax computes it
+#   move           the stored best move is illegal or does not reach that value
+#   missing_child  a child that is not a finished game is not in the table
+#   not_canonical  one of the 8 symmetries of the board has a smaller code,
+#                  so the entry is not the key every symmetric state maps to
+#   wrong_side     the side-to-move bit does not match the pieces played
+#   finished       the state is a finished game, which the memo never stores
+PROBLEMS = ("value", "move", "missing_child", "not_canonical", "wrong_side", "finished")
+# Mismatching entries listed in a report, the rest are only counted
+MAX_EXAMPLES = 20
+
+# Entries of the tables this worker process has opened, by path
+TABLE_ENTRIES = {}
+
+
+def table_entries(game):
+    # (keys, values, moves or None) of the table behind a game's memo, in
+    # key order. Compact tables are sliced straight from the mapped file or
+    # shared memory block.
+    path = game.memo.path
+    if path not in TABLE_ENTRIES:
+        table = game.memo.table
+        if isinstance(table, CompactTable):
+            TABLE_ENTRIES[path] = (table.keys, table.values, table.moves)
+        else:
+            TABLE_ENTRIES[path] = table_columns(table)
+    return TABLE_ENTRIES[path]
+
+
+def empty_report():
+    report = {problem: 0 for problem in PROBLEMS}
+    report["entries"] = 0
+    report["examples"] = []
+    return report
+
+
+def merge_reports(report, other):
+    for problem in PROBLEMS + ("entries",):
+        report[problem] += other[problem]
+    report["examples"] = (report["examples"] + other["examples"])[:MAX_EXAMPLES]
+    return report
+
+
+def add_problems(report, problem, keys, stored, expected):
+    report[problem] += len(keys)
+    for key, stored_value, expected_value in zip(keys, stored, expected):
+        if len(report["examples"]) >= MAX_EXAMPLES:
+            break
+        report["examples"].append({"key": int(key), "problem": problem,
+                                   "stored": int(stored_value), "expected": int(expected_value)})
+
+
+def verify_range(path, begin, end, initial_counts=INITIAL_COUNTS):
+    # Check entries begin..end of the table at `path`; a worker of verify_table
+    game = TicTacToe(initial_counts=initial_counts, memo_file_path=path)
+    keys, values, moves = table_entries(game)
+    keys = np.asarray(keys[begin:end]).astype(np.int64)
+    values = np.asarray(values[begin:end])
+    moves = np.asarray(moves[begin:end]) if moves is not None else None
+    report = empty_report()
+    report["entries"] = len(keys)
+
+    boards = key_boards(keys)
+    counts = keys & 0xFFF
+    sides = keys >> SIDE_SHIFT
+    total = total_pieces(initial_counts)
+
+    wrong_side = sides != (total - pieces_left(counts)) & 1
+    add_problems(report, "wrong_side", keys[wrong_side], sides[wrong_side], sides[wrong_side] ^ 1)
+    canonical, _ = canonical_forms(boards)
+    not_canonical = canonical != boards
+    add_problems(report, "not_canonical", keys[not_canonical], boards[not_canonical], canonical[not_canonical])
+
+    for side in (0, 1):
+        index = np.flatnonzero((sides == side) & ~wrong_side)
+        if len(index) == 0:
+            continue
+        finished = game_outcomes(boards[index], counts[index], side) != NOT_OVER
+        missing = np.zeros(len(index), dtype=bool)
+        expected, best_moves, move_values = evaluate_chunk(game, boards[index], counts[index], side, missing)
+        add_problems(report, "finished", keys[index[finished]], values[index[finished]], expected[finished])
+        add_problems(report, "missing_child", keys[index[missing]], values[index[missing]], expected[missing])
+
+        checked = ~finished & ~missing
+        wrong = checked & (values[index] != expected)
+        add_problems(report, "value", keys[index[wrong]], values[index[wrong]], expected[wrong])
+        if moves is not None:
+            # Any move reaching the stored value is a best move, ties included
+            stored = moves[index].astype(np.int64)
+            has_move = checked & ~wrong & (stored != NO_MOVE)
+            reached = move_values[np.arange(len(index)), np.minimum(stored, MOVE_COUNT - 1)]
+            wrong = has_move & ((stored >= MOVE_COUNT) | (reached != values[index]))
+            add_problems(report, "move", keys[index[wrong]], stored[wrong], best_moves[wrong])
+    return report
+
+
+def verify_table(path, jobs=1, initial_counts=INITIAL_COUNTS, block=CHUNK_SIZE):
+    # Check every entry of a built table against its children and its
+    # symmetries. The entries are cut into blocks that `jobs` worker
+    # processes verify with vectorized lookups. A table that is not a
+    # compact file is placed in shared memory once for all of them, rather
+    # than loaded by each. Returns a report counting each of PROBLEMS, with
+    # up to MAX_EXAMPLES of the offending entries and the entries verified
+    # per second.
+    start = time.perf_counter()
+    game = TicTacToe(initial_counts=initial_counts, memo_file_path=path)
+    shared = None
+    if jobs > 1 and not isinstance(game.memo.table, CompactTable):
+        shared = SharedMemoryTable.create(game.memo)
+        path = shared.path
+    count = len(table_entries(TicTacToe(initial_counts=initial_counts, memo_file_path=path))[0])
+    begins = list(range(0, count, block))
+    ends = [min(begin + block, count) for begin in begins]
+    report = empty_report()
+    try:
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                for block_report in executor.map(verify_range, repeat(path), begins, ends, repeat(initial_counts)):
+                    merge_reports(report, block_report)
+        else:
+            for begin, end in zip(begins, ends):
+                merge_reports(report, verify_range(path, begin, end, initial_counts))
+    finally:
+        TABLE_ENTRIES.pop(shared_table(path).path, None)
+        if shared is not None:
+            release(path)
+            shared.unlink()
+    report["seconds"] = time.perf_counter() - start
+    report["entries_per_second"] = report["entries"] / report["seconds"] if report["seconds"] else 0.0
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify a built Replace-TTT table")
+    parser.add_argument("table", nargs="?", default="full_search_updated.tb",
+                        help="compact (.tb), ranked (.rtb) or compressed (.ctb) table, or pickled memo dict")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes")
+    parser.add_argument("--output", default=None, help="write the report here as JSON")
+    args = parser.parse_args()
+
+    report = verify_table(args.table, jobs=args.jobs)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+            file.write("\n")
+    print(f"Verified {report['entries']} entries in {report['seconds']:.1f}s "
+          f"({report['entries_per_second']:.0f} entries/s)")
+    for problem in PROBLEMS:
+        print(f"{problem:14} {report[problem]}")
+    for example in report["examples"]:
+        print(f"  {example['problem']}: key {example['key']} stored {example['stored']} expected {example['expected']}")
+    if any(report[problem] for problem in PROBLEMS):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()